@@ -0,0 +1,125 @@
+import argparse
+import hashlib
+import pathlib
+import re
+import tempfile
+import time
+
+from src.manifest import diff_manifests, from_bytes, read_manifest, to_bytes
+
+
+def read_manifest_regex(file: pathlib.Path) -> list[tuple[str, str]]:
+    """The previous parser, matching an uncompiled pattern against every line. Kept for comparison.
+
+    Args:
+        file (pathlib.Path): Path to the manifest file
+
+    Returns:
+        list[tuple[str, str]]: The name and hash of every file
+    """
+    def expectMatch(pattern: str, line: str) -> re.Match[str]:
+        match = re.match(pattern, line)
+
+        if match is None:
+            raise ValueError(f"Could not match pattern '{pattern}' against line '{line}'")
+
+        return match
+
+    files = []
+
+    with open(file, "r") as f:
+        expectMatch(r".* (\d+)", f.readline())
+        f.readline()
+        expectMatch(r".* : (\d+) \/ (.+)", f.readline())
+        for _ in range(4):
+            expectMatch(r".* : (\d+)", f.readline())
+        f.readline()
+        f.readline()
+        f.readline()
+
+        while line := f.readline():
+            match = expectMatch(r"\s+\d+\s+\d+\s+(?P<hash>.{40})\s+\d+\s+(?P<name>.+)", line)
+            files.append((match.group("name"), match.group("hash")))
+
+    return files
+
+
+def write_sample_manifest(file: pathlib.Path, num_files: int) -> None:
+    """Write a manifest file in the format of DepotDownloader with generated entries.
+
+    Args:
+        file (pathlib.Path): The target file
+        num_files (int): The number of file entries
+    """
+    lines = [
+        "Content Manifest for Depot 813781 ",
+        "",
+        "Manifest ID / date     : 5086945717428610355 / 11/15/2019 21:43:41",
+        f"Total number of files  : {num_files}",
+        f"Total number of chunks : {num_files * 2}",
+        f"Total bytes on disk    : {num_files * 123456}",
+        f"Total bytes compressed : {num_files * 100000}",
+        "",
+        "",
+        "          Size Chunks File SHA                                 Flags Name",
+    ]
+
+    for i in range(num_files):
+        sha = hashlib.sha1(str(i).encode()).hexdigest()
+        lines.append(f"{i * 37 % 10000000:>14} {i % 20:>6} {sha} {0:>5} resources\\_common\\drs\\gamedata_x2\\file {i}.dat")
+
+    file.write_text("\n".join(lines) + "\n")
+
+
+def measure(func, repeat: int) -> float:
+    best = float("inf")
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=50000, help="Number of files in the generated manifest")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--manifest", type=pathlib.Path, help="Use an existing manifest file instead of a generated one")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        file = args.manifest
+
+        if file is None:
+            file = pathlib.Path(tmp) / "manifest.txt"
+            write_sample_manifest(file, args.files)
+
+        parsed = read_manifest(file)
+        data = to_bytes(parsed)
+
+        # Every 100th file modified and every 1000th file removed
+        changed = from_bytes(data)
+        changed.files = [(name, bytes(20) if i % 100 == 0 else digest, size) for i, (name, digest, size) in enumerate(changed.files) if i % 1000 != 1]
+
+        assert from_bytes(data) == parsed
+        assert [(name, digest.hex()) for (name, digest, _) in parsed.files] == [(name, sha.lower()) for (name, sha) in read_manifest_regex(file)]
+
+        results = [
+            ("regex parser (previous)", measure(lambda: read_manifest_regex(file), args.repeat)),
+            ("split parser", measure(lambda: read_manifest(file), args.repeat)),
+            ("binary load", measure(lambda: from_bytes(data), args.repeat)),
+            ("binary save", measure(lambda: to_bytes(parsed), args.repeat)),
+            ("diff", measure(lambda: diff_manifests(parsed, changed), args.repeat)),
+            ("diff (same files)", measure(lambda: diff_manifests(parsed, parsed), args.repeat)),
+        ]
+
+        print(f"{len(parsed.files)} files, text {file.stat().st_size} bytes, binary {len(data)} bytes")
+
+        for name, seconds in results:
+            print(f"{name:<24} {seconds * 1000:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+import argparse
+import json
+import os
+import pathlib
+import statistics
+import subprocess
+import sys
+import tempfile
+
+SRC_DIR = pathlib.Path(__file__).absolute().parent.parent / "src"
+
+# Modules that are only needed once the user does something and must not be imported before the window is shown
+DEFERRED_MODULES = ["pefile", "requests", "tkinter.filedialog", "tkinter.simpledialog"]
+
+# Runs in a fresh interpreter so every import is measured cold.
+# The network is simulated as hanging, the window must show up regardless.
+CHILD = """
+import json
+import pathlib
+import sys
+import time
+
+start = time.perf_counter()
+
+import utils
+utils.base_path = lambda: pathlib.Path(sys.argv[1])
+
+import web_helper
+
+def hang(*args, **kwargs):
+    time.sleep(float(sys.argv[2]))
+    raise OSError("Network disabled")
+
+web_helper.WebHelper._query_website = hang
+
+import app
+
+result = {"import": time.perf_counter() - start, "window": None, "loaded": [m for m in json.loads(sys.argv[3]) if m in sys.modules]}
+
+try:
+    instance = app.App(0, 0)
+except Exception as e:
+    result["error"] = str(e)
+    print(json.dumps(result), file=sys.__stdout__)
+    sys.exit(0)
+
+def shown():
+    result["window"] = time.perf_counter() - start
+    result["loaded"] = [m for m in json.loads(sys.argv[3]) if m in sys.modules]
+    print(json.dumps(result), file=sys.__stdout__)
+    instance.window.destroy()
+
+instance.window.after(0, shown)
+instance.start()
+"""
+
+
+def measure(work_dir: pathlib.Path, network_delay: float) -> dict:
+    env = dict(os.environ, PYTHONPATH=str(SRC_DIR))
+    output = subprocess.run([sys.executable, "-c", CHILD, str(work_dir), str(network_delay), json.dumps(DEFERRED_MODULES)],
+                            env=env, capture_output=True, text=True, timeout=60 + network_delay)
+
+    if output.returncode != 0:
+        raise RuntimeError(f"Start-up failed:\n{output.stderr}")
+
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the time until the window of the patcher is shown while the network hangs")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--network-delay", type=float, default=10, help="Seconds every simulated request hangs")
+    parser.add_argument("--max-seconds", type=float, default=2, help="Fail if the window takes longer to show up")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = [measure(pathlib.Path(tmp), args.network_delay) for _ in range(args.repeat)]
+
+    imports = statistics.median(result["import"] for result in results)
+    print(f"{'imports':<10} {imports * 1000:10.1f} ms")
+
+    failed = False
+
+    if results[0]["window"] is None:
+        # No display available, only the imports can be measured
+        print(f"Window not measured: {results[0].get('error')}")
+    else:
+        window = statistics.median(result["window"] for result in results)
+        print(f"{'window':<10} {window * 1000:10.1f} ms")
+
+        if window > args.max_seconds:
+            print(f"Window took longer than {args.max_seconds} s to show up")
+            failed = True
+
+    loaded = sorted({module for result in results for module in result["loaded"]})
+    if len(loaded) > 0:
+        print(f"Imported during start-up: {', '.join(loaded)}")
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import json
+import argparse
+import subprocess
+import os
+import tempfile
+from pathlib import Path
+
+from src.manifest import diff_manifests, read_manifest
+
+
+def load_last_patch(path: Path) -> dict:
+    """Load the last documented patch from the patches JSON or an empty one if it doesn't exist.
+
+    Args:
+        path (Path): The path to the patches file
+
+    Returns:
+        dict: The last documented patch
+    """
+    if not path.exists():
+        return {}
+
+    with open(path) as f:
+        data = json.load(f)
+
+    if not data.get("patches"):
+        return {}
+
+    return data["patches"][-1]
+
+
+def download_manifests(depotdownloader: str, app_id: int, manifests: list[tuple[int, int]], download_dir: Path) -> None:
+    """Download the human readable manifests for the given depots.
+
+    Args:
+        depotdownloader (str): The path to the DepotDownloader executable
+        app_id (int): The app id
+        manifests (list[tuple[int, int]]): A list of (depot id, manifest id) pairs, every depot may only be contained once
+        download_dir (Path): The directory the manifest files will be placed in
+    """
+    subprocess.run([
+        depotdownloader,
+        "-app", str(app_id),
+        "-depot", *[str(depot_id) for (depot_id, _) in manifests],
+        "-manifest", *[str(manifest_id) for (_, manifest_id) in manifests],
+        "-dir", str(download_dir),
+        "-username", os.environ["STEAM_USERNAME"],
+        "-password", os.environ["STEAM_PASSWORD"],
+        "-remember-password",
+        "-manifest-only",
+    ], check=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--app-id", type=int, required=True)
+    parser.add_argument("--depots", required=True, help="JSON list of {depot_id, manifest_id}")
+    parser.add_argument("--game-version", type=int, required=True)
+    parser.add_argument("--patches-file", default="remote/patches.json")
+    parser.add_argument("--diffs-dir", default="remote/diffs")
+    parser.add_argument("--depotdownloader", default="./depotdownloader/DepotDownloader")
+    args = parser.parse_args()
+
+    last_patch = load_last_patch(Path(args.patches_file))
+    if not last_patch or last_patch["version"] == args.game_version:
+        print("No previous version to compare against, skipping diff.")
+        return
+
+    old_depots = {d["depot_id"]: d["manifest_id"] for d in last_patch["depots"]}
+    new_depots = {d["depot_id"]: d["manifest_id"] for d in json.loads(args.depots)}
+
+    # Only depots that exist in both versions and have a new manifest
+    changed = [(depot_id, old_depots[depot_id], manifest_id) for depot_id, manifest_id in new_depots.items()
+               if depot_id in old_depots and old_depots[depot_id] != manifest_id]
+
+    result = {
+        "old_version": last_patch["version"],
+        "new_version": args.game_version,
+        "depots": {},
+    }
+
+    if changed:
+        with tempfile.TemporaryDirectory() as tmp:
+            old_dir = Path(tmp) / "old"
+            new_dir = Path(tmp) / "new"
+
+            download_manifests(args.depotdownloader, args.app_id, [(d, old) for (d, old, _) in changed], old_dir)
+            download_manifests(args.depotdownloader, args.app_id, [(d, new) for (d, _, new) in changed], new_dir)
+
+            for depot_id, old_manifest_id, new_manifest_id in changed:
+                old_manifest = read_manifest(old_dir / f"manifest_{depot_id}_{old_manifest_id}.txt")
+                new_manifest = read_manifest(new_dir / f"manifest_{depot_id}_{new_manifest_id}.txt")
+
+                result["depots"][str(depot_id)] = {
+                    "old_manifest": old_manifest_id,
+                    "new_manifest": new_manifest_id,
+                    **diff_manifests(old_manifest, new_manifest).to_dict(),
+                }
+
+    diffs_dir = Path(args.diffs_dir)
+    diffs_dir.mkdir(parents=True, exist_ok=True)
+    diff_path = diffs_dir / f"{last_patch['version']}-{args.game_version}.json"
+
+    with open(diff_path, "w") as f:
+        json.dump(result, f, separators=(",", ":"))
+
+    print(f"Wrote diff: {diff_path}")
+
+
+if __name__ == '__main__':
+    main()
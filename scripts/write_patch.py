@@ -3,37 +3,47 @@ import argparse
 import time
 from pathlib import Path
 
+from src.patch_history import PatchHistory
+
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--patches-file", default="remote/patches.json")
+    parser.add_argument("--patches-file", default="remote/patches.json", help="Full list of all patches, generated from the history for older clients")
+    parser.add_argument("--history-file", default="remote/history.jsonl", help="Append-only history of all patches")
     parser.add_argument("--depots", required=True, help="JSON list of {depot_id, manifest_id}")
     parser.add_argument("--game-version", type=int, required=True)
     args = parser.parse_args()
 
     depots = json.loads(args.depots)
     patches_path = Path(args.patches_file)
+    history_path = Path(args.history_file)
 
-    if patches_path.exists():
+    if history_path.exists():
+        history = PatchHistory.parse(history_path.read_bytes())
+    elif patches_path.exists():
+        # Convert the existing list once, the history is only appended to afterwards
         with open(patches_path) as f:
-            data = json.load(f)
+            history = PatchHistory.from_patches(json.load(f)["patches"])
+
+        history_path.parent.mkdir(parents=True, exist_ok=True)
+        history_path.write_text("".join(PatchHistory.encode(entry) + "\n" for entry in history.entries))
+        print(f"Converted {len(history.entries)} patches to {history_path}")
     else:
-        data = {"patches": []}
+        history = PatchHistory([])
 
-    last_version = data["patches"][-1].get("version") if data["patches"] else None
+    last_version = history.entries[-1].version if history.entries else None
     if last_version == args.game_version:
         print("Game version unchanged, skipping write.")
         return
 
-    data["patches"].append({
-        "version": args.game_version,
-        "date": int(time.time()),
-        "depots": depots,
-    })
+    entry = history.append(args.game_version, int(time.time()), {d["depot_id"]: d["manifest_id"] for d in depots})
+
+    history_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(history_path, "a") as f:
+        f.write(PatchHistory.encode(entry) + "\n")
 
-    patches_path.parent.mkdir(parents=True, exist_ok=True)
     with open(patches_path, "w") as f:
-        json.dump(data, f, indent=4)
+        json.dump({"patches": history.patches()}, f, indent=4)
 
     print(f"Wrote new patch: game_version={args.game_version}")
 
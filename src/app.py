@@ -6,18 +6,27 @@ import time
 import tkinter as tk
 import tkinter.scrolledtext as scrolledtext
 import tkinter.ttk as ttk
-import tkinter.filedialog
 import tkinter.messagebox
 
 import redirector
 from logic import Logic
-from utils import base_path
+from patch_index import PatchIndex
+from patch_planner import PatchPlan
+from progress import ProgressTracker
+from utils import base_path, format_duration, format_size, get_game_version
 
 
 class App():
+    # Milliseconds between two updates of the progress bar
+    PROGRESS_INTERVAL = 500
+    # Downloads without progress for this many seconds are shown as stalled, the same limit drops their rate from the estimate
+    STALL_SECONDS = ProgressTracker.STALL_SECONDS
+
     def __init__(self, version_major: int, version_minor: int):
         self.logic = Logic()
-        self.patch_list = list(reversed(self.logic.get_patch_list()))
+        self.patch_index = self.logic.get_patch_index()
+        # Versions in the order of the selection, newest first
+        self.patch_versions = list(reversed(self.patch_index.versions))
 
         self.version_major = version_major
         self.version_minor = version_minor
@@ -31,9 +40,9 @@ class App():
         def on_closing():
             self.logic.cancel_downloads()
 
-            # Log text box content to file
-            with open(base_path() / "log.txt", "w+") as file:
-                file.write(self.text_box.get(1.0, "end-1c"))
+            # Write remaining output to the log file
+            sys.stdout.close()
+            sys.stdout = sys.__stdout__
 
             self.window.destroy()
 
@@ -56,14 +65,22 @@ class App():
 
         self.selected_patch_title = tk.StringVar()
 
-        patch_titles = [f"{p['version']} - {time.strftime('%d/%m/%Y', time.gmtime(p['date']))}" for p in self.patch_list]
+        patch_titles = [self._patch_title(self.patch_index.get(v)) for v in self.patch_versions]
 
         self.lbl_select_patch = ttk.Label(master=self.upper_frame, text="Target version")
         self.lbl_select_patch.grid(row=0, column=0, sticky="e")
         self.cmb_select_patch = ttk.Combobox(self.upper_frame, state="readonly", textvariable=self.selected_patch_title, values=[p for p in patch_titles])
-        self.cmb_select_patch.current(0)    # Set default value
+        if len(patch_titles) > 0:
+            self.cmb_select_patch.current(0)    # Set default value
         self.cmb_select_patch.grid(row=0, column=1, sticky="ew")
 
+        self.restore_points = []
+
+        self.lbl_restore_point = ttk.Label(master=self.upper_frame, text="Restore point")
+        self.lbl_restore_point.grid(row=1, column=0, sticky="e")
+        self.cmb_restore_point = ttk.Combobox(self.upper_frame, state="readonly", values=[])
+        self.cmb_restore_point.grid(row=1, column=1, sticky="ew")
+
         self.lbl_username = ttk.Label(master=self.upper_frame, text="Username")
         self.lbl_username.grid(row=2, column=0, sticky="e")
         self.ent_username = ttk.Entry(master=self.upper_frame)
@@ -75,24 +92,97 @@ class App():
         self.btn_restore = ttk.Button(master=self.upper_frame, text="Restore", command=self._restore)
         self.btn_restore.grid(row=1, column=5, sticky="nesw")
 
+        self.btn_verify = ttk.Button(master=self.upper_frame, text="Verify / Repair", command=self._verify)
+        self.btn_verify.grid(row=0, column=4, sticky="nesw")
+
         self.btn_game_dir = ttk.Button(master=self.upper_frame, text="Set Game directory", command=self._select_game_dir)
         self.btn_game_dir.grid(row=2, column=5, sticky="nesw")
 
+        self.progress_frame = tk.Frame(master=self.lower_frame)
+        self.progress_frame.pack(side="top", fill="x", pady=(0, 5))
+        self.progress_bar = ttk.Progressbar(master=self.progress_frame, mode="determinate", maximum=100)
+        self.progress_bar.pack(side="left", expand=True, fill="x")
+        self.lbl_progress = ttk.Label(master=self.progress_frame, text="", width=45, anchor="e")
+        self.lbl_progress.pack(side="right", padx=(5, 0))
+
         self.text_box = scrolledtext.ScrolledText(master=self.lower_frame, state="disabled")
         self.text_box.pack(expand=True, fill="both")
 
         # Redirect stdout to the text box
-        sys.stdout = redirector.StdoutRedirector(self.text_box)
+        sys.stdout = redirector.StdoutRedirector(self.text_box, base_path() / "log.txt")
 
     def start(self) -> None:
         """Start the application.
         """
-        self._check_version()
+        # The window is shown right away, remote data is queried in the background
+        t = threading.Thread(target=self._refresh_remote, daemon=True)
+        t.start()
+
+        self.window.after(self.PROGRESS_INTERVAL, self._update_progress)
         self.window.mainloop()
 
+    def _update_progress(self) -> None:
+        """Show the combined progress of all downloads with throughput and remaining time. Runs on the Tk loop.
+        """
+        total = self.logic.progress.total()
+
+        if total.bytes_total > 0:
+            text = f"{format_size(total.bytes_done)} / {format_size(total.bytes_total)}"
+
+            if total.bytes_done < total.bytes_total:
+                if total.eta is not None:
+                    text += f" - {format_size(int(total.rate))}/s, {format_duration(total.eta)} left"
+
+                # A slow download still makes progress every now and then, a stalled one doesn't.
+                # Each download is checked on its own, one stalled depot is hidden by the progress of the others otherwise
+                stalled = [download for download in self.logic.progress.downloads_in_progress() if download.idle >= self.STALL_SECONDS]
+                if len(stalled) > 0:
+                    text += " - stalled: " + ", ".join(f"{download.name} for {format_duration(download.idle)}" for download in stalled)
+
+            self.progress_bar.config(value=100 * total.bytes_done / total.bytes_total)
+            self.lbl_progress.config(text=text)
+
+        self.window.after(self.PROGRESS_INTERVAL, self._update_progress)
+
+    def _refresh_remote(self) -> None:
+        """Refresh the patch list and check for a newer version of the tool. Runs in the background.
+        """
+        try:
+            patch_index = self.logic.refresh_patch_index()
+            self.window.after(0, lambda: self._set_patch_index(patch_index))
+        except Exception as e:
+            print(f"Could not refresh the patch list: {e}")
+
+        try:
+            self._check_version()
+        except Exception as e:
+            print(f"Could not check for a newer version: {e}")
+
+    def _set_patch_index(self, patch_index: PatchIndex) -> None:
+        """Show a new patch list, the selected version stays selected if it still exists.
+
+        Args:
+            patch_index (PatchIndex): The index of all patches
+        """
+        selected_patch = self._selected_patch()
+
+        self.patch_index = patch_index
+        self.patch_versions = list(reversed(patch_index.versions))
+        self.cmb_select_patch.config(values=[self._patch_title(patch_index.get(v)) for v in self.patch_versions])
+
+        if selected_patch is not None and selected_patch["version"] in patch_index:
+            self.cmb_select_patch.current(self.patch_versions.index(selected_patch["version"]))
+        elif len(self.patch_versions) > 0:
+            self.cmb_select_patch.current(0)
+
+        if getattr(self.logic, "game_dir", None) is not None:
+            self._update_patch_estimates()
+
     def _select_game_dir(self) -> None:
         """Open a file dialog for the user to select the game folder and send the result to logic.
         """
+        import tkinter.filedialog
+
         dir = tkinter.filedialog.askdirectory(mustexist=True)
 
         # askdirectory returns empty string on hitting cancel
@@ -101,6 +191,88 @@ class App():
                 self.logic.set_game_dir(pathlib.Path(dir))
             except Exception as e:
                 tkinter.messagebox.showerror(title="ERROR", message=str(e))
+                return
+
+            self._update_patch_estimates()
+            self._update_restore_points()
+
+    def _update_patch_estimates(self) -> None:
+        """Estimate the download size of every patch in the background and show it next to the patch titles.
+        """
+        patch_index = self.patch_index
+        versions = self.patch_versions
+
+        def work():
+            try:
+                plans = self.logic.plan_patches()
+            except Exception as e:
+                print(f"Could not estimate patch sizes: {e}")
+                return
+
+            titles = [self._patch_title(patch_index.get(v), plans.get(v)) for v in versions]
+
+            def update():
+                # The patch list has been refreshed in the meantime
+                if self.patch_versions is not versions:
+                    return
+
+                selected = self.cmb_select_patch.current()
+                self.cmb_select_patch.config(values=titles)
+
+                # Nothing is selected while the list is empty
+                if selected >= 0:
+                    self.cmb_select_patch.current(selected)
+
+            self.window.after(0, update)
+
+        t = threading.Thread(target=work, daemon=True)
+        t.start()
+
+    def _update_restore_points(self) -> None:
+        """Show the restore points of the game directory, newest first.
+        """
+        self.restore_points = list(reversed(self.logic.get_restore_points()))
+        titles = [f"{p.version} - {time.strftime('%d/%m/%Y %H:%M', time.localtime(p.date))} ({format_size(p.size)})" for p in self.restore_points]
+
+        def update():
+            self.cmb_restore_point.config(values=titles)
+
+            if len(titles) > 0:
+                self.cmb_restore_point.current(0)
+            else:
+                self.cmb_restore_point.set("")
+
+        self.window.after(0, update)
+
+    def _patch_title(self, patch: dict, plan: PatchPlan | None = None) -> str:
+        """Get the title of a patch as shown in the selection.
+
+        Args:
+            patch (dict): The patch
+            plan (PatchPlan, optional): The plan to patch to this version, its estimated download size is appended if it is exact. Defaults to None.
+
+        Returns:
+            str: The title
+        """
+        title = f"{patch['version']} - {time.strftime('%d/%m/%Y', time.gmtime(patch['date']))}"
+
+        if plan is not None and plan.complete:
+            title += f" (~{format_size(plan.download_size)})"
+
+        return title
+
+    def _selected_patch(self) -> dict | None:
+        """Get the patch selected as target version.
+
+        Returns:
+            dict | None: The patch or None if nothing is selected
+        """
+        selected = self.cmb_select_patch.current()
+
+        if not 0 <= selected < len(self.patch_versions):
+            return None
+
+        return self.patch_index.get(self.patch_versions[selected])
 
     def _check_version(self) -> None:
         """Check if there is a newer version of the tool available. Notify the user with a box if that is the case.
@@ -115,7 +287,7 @@ class App():
         """Start patching the game with the downloaded files.
         """
         # Retrieve selected patch
-        selected_patch = next((p for p in self.patch_list if str(p['version']) in self.selected_patch_title.get()), None)
+        selected_patch = self._selected_patch()
         if selected_patch is None:
             tkinter.messagebox.showerror(title="ERROR", message="Could not retrieve selected patch version")
             return
@@ -123,40 +295,121 @@ class App():
         def work():
             self._disable_input()
 
+            if not self._recover_interrupted_patch():
+                self._enable_input()
+                return
+
             try:
                 self.logic.patch(self.ent_username.get(), selected_patch["version"])
                 tkinter.messagebox.showinfo(message="Patching done")
             except Exception as e:
                 tkinter.messagebox.showerror(title="ERROR", message=str(e))
 
+            # The installed version and the contents of the store have changed
+            self.window.after(0, self._update_patch_estimates)
+            self._update_restore_points()
+            self._enable_input()
+
+        t = threading.Thread(target=work)
+        t.start()
+
+    def _verify(self) -> None:
+        """Verify the game directory against the installed version and repair missing or modified files after asking for confirmation.
+        """
+        if getattr(self.logic, "game_dir", None) is None:
+            tkinter.messagebox.showerror(title="ERROR", message="Please select a game directory")
+            return
+
+        def work():
+            self._disable_input()
+
+            if not self._recover_interrupted_patch():
+                self._enable_input()
+                return
+
+            try:
+                # Files of another version would mix two versions, only ever compare against the installed one
+                installed = get_game_version(self.logic.game_dir)
+                username = self.ent_username.get()
+                mismatched = self.logic.verify(username, installed)
+
+                if len(mismatched) == 0:
+                    tkinter.messagebox.showinfo(message=f"Verifying done, all files match version {installed}")
+                elif tkinter.messagebox.askyesno(title="Repair", message=f"{len(mismatched)} files are missing or don't match version {installed}. Repair them?"):
+                    mismatched = self.logic.verify(username, installed, True)
+                    tkinter.messagebox.showinfo(message=f"Verifying done, {len(mismatched)} files repaired")
+
+                    # Downloaded contents have been added to the store
+                    self.window.after(0, self._update_patch_estimates)
+            except Exception as e:
+                tkinter.messagebox.showerror(title="ERROR", message=str(e))
+
             self._enable_input()
 
         t = threading.Thread(target=work)
         t.start()
 
     def _restore(self) -> None:
-        """Restores the game directory using the backed up files and downloaded files.
+        """Restores the game directory to the selected restore point.
         """
+        selected = self.cmb_restore_point.current()
+        restore_point = self.restore_points[selected] if 0 <= selected < len(self.restore_points) else None
+
         def work():
             self._disable_input()
 
+            if not self._recover_interrupted_patch():
+                self._enable_input()
+                return
+
             try:
-                self.logic.restore()
+                self.logic.restore(restore_point)
                 tkinter.messagebox.showinfo(message="Restore done")
             except Exception as e:
                 tkinter.messagebox.showerror(title="ERROR", message=str(e))
 
+            # The installed version and the contents of the store have changed
+            self.window.after(0, self._update_patch_estimates)
+            self._update_restore_points()
             self._enable_input()
 
         t = threading.Thread(target=work)
         t.start()
 
+    def _recover_interrupted_patch(self) -> bool:
+        """Offer to retry recovering an interrupted patch, nothing else may touch the game directory until it has been recovered.
+        Runs on a worker thread.
+
+        Returns:
+            bool: True if no interrupted patch is pending anymore
+        """
+        if not self.logic.has_interrupted_patch():
+            return True
+
+        if not tkinter.messagebox.askretrycancel(title="Interrupted patch",
+                                                 message="The previous patch has been interrupted and could not be completed or reverted yet. "
+                                                         "Its backup still holds the original files. Retry recovering it now?"):
+            return False
+
+        try:
+            self.logic.recover()
+        except Exception as e:
+            tkinter.messagebox.showerror(title="ERROR", message=str(e))
+            return False
+
+        # Completing the patch creates a restore point
+        self._update_restore_points()
+
+        return True
+
     def _disable_input(self) -> None:
         """Disables User input for certain Buttons / Entries.
         """
         self.cmb_select_patch.config(state="disabled")
+        self.cmb_restore_point.config(state="disabled")
         self.btn_patch.config(state="disabled")
         self.btn_restore.config(state="disabled")
+        self.btn_verify.config(state="disabled")
         self.btn_game_dir.config(state="disabled")
         self.ent_username.config(state="disabled")
 
@@ -164,7 +417,9 @@ class App():
         """Enables User input for certain Buttons / Entries.
         """
         self.cmb_select_patch.config(state="readonly")
+        self.cmb_restore_point.config(state="readonly")
         self.btn_patch.config(state="enabled")
         self.btn_restore.config(state="enabled")
+        self.btn_verify.config(state="enabled")
         self.btn_game_dir.config(state="enabled")
         self.ent_username.config(state="enabled")
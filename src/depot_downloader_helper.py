@@ -1,14 +1,13 @@
-import os
+import itertools
+import locale
 import sys
 import subprocess
 import re
-from queue import Queue
+import threading
+from collections.abc import Callable
 from enum import Enum
 
-import time
-import tkinter
-import tkinter.simpledialog
-
+from process_output import ProcessOutputWatcher
 import utils
 
 
@@ -20,60 +19,166 @@ class ProcessState(Enum):
     AUTH_PASSWORD_REQUIRED = 4
     AUTH_STEAM_GUARD = 5
     AUTH_TWO_FACTOR = 6
+    PROGRESS = 7
+
+
+# Output that changes the state of a process, the name of the matching group is the state
+STATE_PATTERN = re.compile(
+    r"(?P<AUTH_TWO_FACTOR>STEAM GUARD! Please enter .*: )"
+    r"|(?P<AUTH_STEAM_GUARD>STEAM GUARD! Use .*\.\.\.)"
+    r"|(?P<AUTH_PASSWORD_REQUIRED>Enter account password.*: )"
+    r"|(?P<AUTH_SUCCESS>result: OK)"
+    r"|(?P<AUTH_FAILED>Error: InitializeSteam failed|Authentication failed)"
+    r"|(?P<PROGRESS>^ *(?P<percent>\d{1,3}\.\d{2})% )"
+)
 
 
 class DepotDownloaderHelper:
     def __init__(self):
-        self.process_queue = Queue()
-
-    def execute(self, options: list) -> None:
+        # Registry of all currently running processes, execute may be called from several threads at once
+        self.processes: list[subprocess.Popen] = []
+        self.process_lock = threading.Lock()
+        # Set while downloads are cancelled, no new processes will be started until reset
+        self.cancelled = threading.Event()
+        # Only ever show one authentication prompt at a time
+        self.prompt_lock = threading.Lock()
+        # Only one process logs in interactively, all others wait for it and reuse the remembered login afterwards
+        self.login_lock = threading.Lock()
+        self.authenticated = threading.Event()
+        self.session_username: str | None = None
+        # Concurrent DepotDownloader instances need a unique login id
+        self.login_ids = itertools.count(1)
+        # Output of all processes is watched by the same watcher
+        self.output_watcher = ProcessOutputWatcher(STATE_PATTERN)
+
+    def execute(self, options: list, on_login: Callable[[], None] | None = None, on_progress: Callable[[float], None] | None = None) -> None:
         """Execute the DepotDownloader with the given options as arguments.
 
         Args:
             options (list): A list of options that will be passed to DepotDownloader directly
+            on_login (Callable[[], None], optional): Called once the process has logged in successfully. Defaults to None.
+            on_progress (Callable[[float], None], optional): Called with the fraction of the download that is done whenever a file is done. Defaults to None.
 
         Raises:
-            ConnectionError: If there was an error during authentication
+            ConnectionError: If there was an error during authentication or downloads have been cancelled
         """
+        if "-loginid" not in options:
+            options = options + ["-loginid", str(next(self.login_ids))]
+
         args = ["dotnet", str(utils.tools_path('DepotDownloader/DepotDownloader.dll').absolute())] + options
 
-        # Spawn process and store in queue
-        process = subprocess.Popen(
-            args,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1,
-            shell=False,
-            creationflags=subprocess.CREATE_NO_WINDOW if sys.platform == "win32" else 0)
-        self.process_queue.put(process)
-
-        # Set read mode to non-blocking for process to handle prompts without newlines
-        assert process.stdout is not None
-        os.set_blocking(process.stdout.fileno(), False)
+        owns_login = self._acquire_login(options)
+
+        def on_authenticated():
+            nonlocal owns_login
+
+            self.authenticated.set()
+            if owns_login:
+                owns_login = False
+                self.login_lock.release()
+
+            if on_login is not None:
+                on_login()
+
+        try:
+            self._run(args, on_authenticated, on_progress)
+        finally:
+            # Login didn't succeed, let the next waiting process try
+            if owns_login:
+                self.login_lock.release()
+
+    def cancel_downloads(self) -> None:
+        """Performs cleanup for logic object.
+        """
+        with self.process_lock:
+            self.cancelled.set()
+
+            for process in self.processes:
+                process.terminate()
+
+    def reset(self) -> None:
+        """Allow starting new processes again after downloads have been cancelled.
+        """
+        self.cancelled.clear()
+
+    def _run(self, args: list, on_authenticated, on_progress: Callable[[float], None] | None = None) -> None:
+        """Spawn the process and handle it until it has terminated.
+
+        Args:
+            args (list): The full command line
+            on_authenticated (Callable[[], None]): Called once the process has logged in successfully
+            on_progress (Callable[[float], None], optional): Called with the fraction of the download that is done. Defaults to None.
+
+        Raises:
+            ConnectionError: If there was an error during authentication or downloads have been cancelled
+        """
+        # Spawn process and store in registry, hold the lock so a concurrent cancel can't miss it
+        with self.process_lock:
+            if self.cancelled.is_set():
+                raise ConnectionError("Download cancelled")
+
+            process = subprocess.Popen(
+                args,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                bufsize=0,
+                shell=False,
+                creationflags=subprocess.CREATE_NO_WINDOW if sys.platform == "win32" else 0)
+            self.processes.append(process)
 
         try:
-            self._handle_process(process)
+            self._handle_process(process, on_authenticated, on_progress)
         except ConnectionError:
             raise
         finally:
-            # Remove process from queue after working with it
-            self.process_queue.get()
+            # Remove process from registry after working with it
+            with self.process_lock:
+                self.processes.remove(process)
+
             if process.poll() is None:
                 process.terminate()
 
-    def cancel_downloads(self) -> None:
-        """Performs cleanup for logic object.
+    def _acquire_login(self, options: list) -> bool:
+        """Wait until the process with the given options may be started.
+        Only the first process of a session performs the login, all following processes reuse the remembered login.
+
+        Args:
+            options (list): The options of the process
+
+        Returns:
+            bool: True if the process is responsible for logging in and holds the login lock
         """
-        for process in self.process_queue.queue:
-            process.terminate()
+        # Only logins with a remembered password can be reused by other processes
+        if "-username" not in options or "-remember-password" not in options:
+            return False
+
+        username = options[options.index("-username") + 1]
 
-    def _handle_process(self, process: subprocess.Popen) -> None:
+        if self.session_username != username:
+            self.authenticated.clear()
+
+        if self.authenticated.is_set():
+            return False
+
+        self.login_lock.acquire()
+
+        # Another process finished logging in while waiting
+        if self.authenticated.is_set() and self.session_username == username:
+            self.login_lock.release()
+            return False
+
+        self.session_username = username
+
+        return True
+
+    def _handle_process(self, process: subprocess.Popen, on_authenticated, on_progress: Callable[[float], None] | None = None) -> None:
         """Handle process flow and return when process has terminated.
 
         Args:
             process (subprocess.Popen): The process
+            on_authenticated (Callable[[], None]): Called once the process has logged in successfully
+            on_progress (Callable[[float], None], optional): Called with the fraction of the download that is done. Defaults to None.
 
         Raises:
             ConnectionError: If there was an error during authentication
@@ -81,50 +186,24 @@ class DepotDownloaderHelper:
         assert process.stdout is not None
         assert process.stdin is not None
 
-        responses = [
-            (r"STEAM GUARD! Please enter .*: ", ProcessState.AUTH_TWO_FACTOR),
-            (r"STEAM GUARD! Use .*\.\.\.", ProcessState.AUTH_STEAM_GUARD),
-            (r"Enter account password.*: ", ProcessState.AUTH_PASSWORD_REQUIRED),
-            (r"result: OK", ProcessState.AUTH_SUCCESS),
-            (r"Error: InitializeSteam failed", ProcessState.AUTH_FAILED),
-            (r"Authentication failed", ProcessState.AUTH_FAILED)
-        ]
-
-        while True:
-            line = process.stdout.readline()
-            if not line:
-                state = process.poll()
-                # Process terminated
-                if state is not None:
-                    # Without error
-                    if state == 0:
-                        return
-
-                    # Probably wrong .NET version
-                    if state == 2147516566:
-                        raise ConnectionError(f"Download failed with code: {state}\nPossibly outdated .NET version?")
-
-                    # With other error
-                    raise ConnectionError(f"Download failed with code: {state}")
-
-                # No new content but process is alive
-                time.sleep(0.1)
-                continue
+        # Blocks until output is available, prompts without a newline are handed over right away
+        lines = self.output_watcher.watch(process)
 
+        while (line := lines.get()) is not None:
             # Print output in real-time
             sys.stdout.write(line)
             sys.stdout.flush()
 
             # Check patterns
-            response = ProcessState.UNKNOWN
-            for (pattern, state) in responses:
-                if re.search(pattern, line):
-                    response = state
-                    break
+            found = STATE_PATTERN.search(line)
+            response = ProcessState[found.lastgroup] if found is not None else ProcessState.UNKNOWN
 
             match response:
+                case ProcessState.PROGRESS:
+                    if on_progress is not None:
+                        on_progress(float(found.group("percent")) / 100)
                 case ProcessState.AUTH_SUCCESS:
-                    pass
+                    on_authenticated()
                 case ProcessState.AUTH_FAILED:
                     raise ConnectionError("Could not login to steam account")
                 case ProcessState.AUTH_PASSWORD_REQUIRED | ProcessState.AUTH_STEAM_GUARD | ProcessState.AUTH_TWO_FACTOR:
@@ -134,6 +213,20 @@ class DepotDownloaderHelper:
                 case _:
                     pass
 
+        # Process terminated
+        state = process.wait()
+
+        # Without error
+        if state == 0:
+            return
+
+        # Probably wrong .NET version
+        if state == 2147516566:
+            raise ConnectionError(f"Download failed with code: {state}\nPossibly outdated .NET version?")
+
+        # With other error
+        raise ConnectionError(f"Download failed with code: {state}")
+
     def _handle_authentication(self, process: subprocess.Popen, state: ProcessState) -> None:
         """Handle interactive authentication flow.
 
@@ -152,8 +245,7 @@ class DepotDownloaderHelper:
             if password is None:
                 raise ConnectionError("Invalid password")
 
-            process.stdin.write(password + '\n')
-            process.stdin.flush()
+            self._send(process, password + '\n')
 
         def handle_steam_guard():
             pass
@@ -167,18 +259,31 @@ class DepotDownloaderHelper:
             if code is None:
                 raise ConnectionError("Invalid authentication code")
 
-            process.stdin.write(code.upper() + '\n')
-            process.stdin.flush()
+            self._send(process, code.upper() + '\n')
 
-        match state:
-            case ProcessState.AUTH_PASSWORD_REQUIRED:
-                handle_password_required()
-            case ProcessState.AUTH_STEAM_GUARD:
-                handle_steam_guard()
-            case ProcessState.AUTH_TWO_FACTOR:
-                handle_two_factor()
-            case _:
-                sys.stdout.write(f"Unexpected authentication state: {state}")
+        with self.prompt_lock:
+            match state:
+                case ProcessState.AUTH_PASSWORD_REQUIRED:
+                    handle_password_required()
+                case ProcessState.AUTH_STEAM_GUARD:
+                    handle_steam_guard()
+                case ProcessState.AUTH_TWO_FACTOR:
+                    handle_two_factor()
+                case _:
+                    sys.stdout.write(f"Unexpected authentication state: {state}")
+
+    def _send(self, process: subprocess.Popen, text: str) -> None:
+        """Write text to the input of a process.
+
+        Args:
+            process (subprocess.Popen): The process
+            text (str): The text
+        """
+        assert process.stdin is not None
+
+        # Pipes are binary, encode like a process opened in text mode would
+        process.stdin.write(text.encode(locale.getpreferredencoding(False)))
+        process.stdin.flush()
 
     def _open_temp_prompt(self, title: str, prompt: str, is_hidden: bool) -> str | None:
         """Opens a prompt widget with the requested title and prompt to enter information.
@@ -191,6 +296,9 @@ class DepotDownloaderHelper:
         Returns:
             str | None: The entered string or None if invalid or cancelled
         """
+        # Only needed for logins, not worth importing at start-up
+        import tkinter.simpledialog
+
         temp = tkinter.Tk()
         temp.withdraw()
         response = tkinter.simpledialog.askstring(
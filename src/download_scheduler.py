@@ -0,0 +1,52 @@
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+from dataclasses import dataclass
+
+from depot_downloader_helper import DepotDownloaderHelper
+
+
+@dataclass
+class DownloadJob():
+    name: str
+    size: int
+    run: Callable[[], None]
+
+
+class DownloadScheduler:
+    def __init__(self, depot_downloader_helper: DepotDownloaderHelper, max_workers: int):
+        self.depot_downloader_helper = depot_downloader_helper
+        self.max_workers = max(1, max_workers)
+
+    def run(self, jobs: list[DownloadJob]) -> None:
+        """Run all jobs concurrently, starting with the largest ones. Returns once all jobs are done.
+
+        If a job fails all pending jobs are dropped and running downloads are terminated.
+
+        Args:
+            jobs (list[DownloadJob]): The jobs to run
+
+        Raises:
+            Exception: The error of the first job that failed
+        """
+        # Largest jobs first so small depots fill the gaps at the end instead of a large one running alone
+        jobs = sorted(jobs, key=lambda job: job.size, reverse=True)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(job.run): job for job in jobs}
+            done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+
+            failed = next((future for future in done if future.exception() is not None), None)
+
+            if failed is not None:
+                print(f"Download of {futures[failed].name} failed, cancelling remaining downloads")
+
+                for future in pending:
+                    future.cancel()
+
+                self.depot_downloader_helper.cancel_downloads()
+
+                # Wait for running jobs to terminate before reporting the error
+                wait(pending)
+                self.depot_downloader_helper.reset()
+
+                raise Exception(f"Error downloading {futures[failed].name}: {failed.exception()}")
@@ -0,0 +1,134 @@
+import os
+import pathlib
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+
+import utils
+
+
+@dataclass
+class FileOperation():
+    # "move", "backup" (move, copy if not possible), "copy" (hashes the content while copying), "remove" or "mkdir" (creates the target directory)
+    kind: str
+    source: pathlib.Path | None
+    target: pathlib.Path
+    # Expected SHA-1 hash of a copied file, the copy fails if the content doesn't match
+    sha: str | None = None
+
+
+def walk(root: pathlib.Path) -> list[str]:
+    """Recursively list all files in a directory.
+
+    Args:
+        root (pathlib.Path): The directory
+
+    Returns:
+        list[str]: The relative names of all files with forward slashes
+    """
+    result = []
+    stack = [""]
+
+    while stack:
+        prefix = stack.pop()
+
+        try:
+            it = os.scandir(root / prefix)
+        except FileNotFoundError:
+            continue
+
+        with it:
+            for entry in it:
+                name = f"{prefix}/{entry.name}" if prefix else entry.name
+
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(name)
+                else:
+                    result.append(name)
+
+    return result
+
+
+class FileOperationEngine:
+    """Runs planned file operations on a bounded thread pool.
+
+    Target directories are created up front so workers never race on them, progress is reported in batches instead of once per file.
+    """
+    def __init__(self, workers: int = 8, progress_interval: float = 1.0):
+        # Maximum number of operations running at the same time, file operations are mostly bound by latency instead of bandwidth
+        self.workers = max(1, workers)
+        # Minimum number of seconds between two progress reports
+        self.progress_interval = progress_interval
+
+    def run(self, operations: list[FileOperation], description: str) -> dict[pathlib.Path, str]:
+        """Run all operations and return once they are done.
+
+        Args:
+            operations (list[FileOperation]): The operations, they must not depend on each other
+            description (str): Describes the operations in progress reports
+
+        Raises:
+            Exception: If one or more operations failed, lists the first errors
+
+        Returns:
+            dict[pathlib.Path, str]: The hash of every copied file keyed by its target
+        """
+        if len(operations) == 0:
+            return {}
+
+        for directory in sorted({operation.target.parent for operation in operations if operation.kind != "remove"}):
+            directory.mkdir(parents=True, exist_ok=True)
+
+        hashes = {}
+        errors = []
+        done = 0
+        reported = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self._execute, operation): operation for operation in operations}
+
+            for future in as_completed(futures):
+                operation = futures[future]
+                done += 1
+
+                try:
+                    sha = future.result()
+
+                    if sha is not None:
+                        hashes[operation.target] = sha
+                except Exception as e:
+                    errors.append(f"{operation.source or operation.target}: {e}")
+
+                if done == len(operations) or time.monotonic() - reported >= self.progress_interval:
+                    reported = time.monotonic()
+                    print(f"{description}: {done}/{len(operations)} files")
+
+        if len(errors) > 0:
+            raise Exception(f"{description} failed for {len(errors)} files\n" + "\n".join(errors[:10]))
+
+        return hashes
+
+    def _execute(self, operation: FileOperation) -> str | None:
+        """Execute a single operation.
+
+        Args:
+            operation (FileOperation): The operation
+
+        Returns:
+            str | None: The hash of the content for copies
+        """
+        match operation.kind:
+            case "move":
+                utils.move_file(operation.source, operation.target)
+            case "backup":
+                utils.backup_file(operation.source, operation.target)
+            case "copy":
+                return utils.copy_file_with_hash(operation.source, operation.target, operation.sha)
+            case "remove":
+                operation.target.unlink(missing_ok=True)
+            case "mkdir":
+                operation.target.mkdir(exist_ok=True)
+            case _:
+                raise ValueError(f"Unknown file operation '{operation.kind}'")
+
+        return None
@@ -0,0 +1,166 @@
+import json
+import os
+import pathlib
+import tempfile
+import threading
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import utils
+
+
+class HashIndex:
+    """Persistent index of the SHA-1 hashes of all files in a directory.
+
+    Hashes are stored together with size and modification time of the file, only files whose stat changed are hashed again.
+    """
+    FORMAT_VERSION = 1
+
+    def __init__(self, root_dir: pathlib.Path, index_file: pathlib.Path, workers: int | None = None):
+        self.root_dir = root_dir
+        self.index_file = index_file
+        self.workers = workers if workers is not None else min(8, os.cpu_count() or 1)
+        self.lock = threading.Lock()
+        # Relative path (with forward slashes) -> (size, mtime in ns, sha1)
+        self.entries: dict[str, tuple[int, int, str]] = {}
+
+        self._load()
+
+    def update(self, names: list[str] | None = None, progress: Callable[[int, int], None] | None = None) -> dict[str, str]:
+        """Bring the index up to date and return the hashes of the requested files.
+
+        Args:
+            names (list[str], optional): Relative file names to update, updates the whole directory if omitted. Defaults to None.
+            progress (Callable[[int, int], None], optional): Called with (hashed bytes, total bytes) while hashing. Defaults to None.
+
+        Returns:
+            dict[str, str]: The hash of every requested file that exists, keyed by the given name
+        """
+        requested = {}
+
+        if names is None:
+            stats = self._scan()
+            # Forget files that don't exist anymore
+            self.entries = {name: entry for name, entry in self.entries.items() if name in stats}
+        else:
+            stats = {}
+
+            for original in names:
+                name = self._normalize(original)
+                requested[original] = name
+
+                try:
+                    stat = (self.root_dir / name).stat()
+                except OSError:
+                    self.entries.pop(name, None)
+                    continue
+
+                stats[name] = (stat.st_size, stat.st_mtime_ns)
+
+        # Only hash files that are new or whose stat changed
+        outdated = [name for name, (size, mtime) in stats.items()
+                    if name not in self.entries or self.entries[name][:2] != (size, mtime)]
+
+        total = sum(stats[name][0] for name in outdated)
+        done = 0
+
+        if len(outdated) > 0:
+            with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+                futures = {executor.submit(utils.sha1_file, self.root_dir / name): name for name in outdated}
+
+                for future in as_completed(futures):
+                    name = futures[future]
+
+                    try:
+                        sha = future.result()
+                    except OSError:
+                        # File vanished or is not readable, treat it as missing
+                        self.entries.pop(name, None)
+                        continue
+
+                    self.entries[name] = (*stats[name], sha)
+                    done += stats[name][0]
+
+                    if progress is not None:
+                        progress(done, total)
+
+            self._save()
+
+        if names is None:
+            return {name: self.entries[name][2] for name in stats if name in self.entries}
+
+        return {original: self.entries[name][2] for original, name in requested.items() if name in self.entries}
+
+    def add(self, hashes: dict[str, str]) -> None:
+        """Record the known hashes of files that have just been written, for example when they were hashed while copying.
+
+        Args:
+            hashes (dict[str, str]): Relative file name -> hash
+        """
+        for original, sha in hashes.items():
+            name = self._normalize(original)
+
+            try:
+                stat = (self.root_dir / name).stat()
+            except OSError:
+                continue
+
+            self.entries[name] = (stat.st_size, stat.st_mtime_ns, sha)
+
+        if len(hashes) > 0:
+            self._save()
+
+    def _normalize(self, name: str) -> str:
+        return name.replace("\\", "/")
+
+    def _scan(self) -> dict[str, tuple[int, int]]:
+        """Recursively collect size and modification time of all files in the directory.
+
+        Returns:
+            dict[str, tuple[int, int]]: Relative file name -> (size, mtime in ns)
+        """
+        result = {}
+        stack = [""]
+
+        while stack:
+            prefix = stack.pop()
+
+            with os.scandir(self.root_dir / prefix) as it:
+                for entry in it:
+                    name = f"{prefix}/{entry.name}" if prefix else entry.name
+
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(name)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        result[name] = (stat.st_size, stat.st_mtime_ns)
+
+        return result
+
+    def _load(self) -> None:
+        try:
+            with open(self.index_file) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if data.get("version") != self.FORMAT_VERSION or data.get("root") != str(self.root_dir.absolute()):
+            return
+
+        self.entries = {name: tuple(entry) for name, entry in data["files"].items()}
+
+    def _save(self) -> None:
+        data = {
+            "version": self.FORMAT_VERSION,
+            "root": str(self.root_dir.absolute()),
+            "files": self.entries,
+        }
+
+        with self.lock:
+            self.index_file.parent.mkdir(parents=True, exist_ok=True)
+
+            # Write to temp file first so a crash never leaves a partial index behind
+            fd, tmp = tempfile.mkstemp(dir=self.index_file.parent, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f, separators=(",", ":"))
+            os.replace(tmp, self.index_file)
@@ -1,10 +1,29 @@
+import functools
+import hashlib
 import os
 import pathlib
+import queue
 import shutil
 import tempfile
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from depot_downloader_helper import DepotDownloaderHelper
+from download_scheduler import DownloadJob, DownloadScheduler
+from file_operations import FileOperation, FileOperationEngine
+from hash_index import HashIndex
+from manifest_cache import ManifestCache
+from object_store import ObjectStore
+from patch_journal import JournalRecord, PatchJournal
+from patch_history import PatchHistory
+from patch_index import PatchIndex
+from patch_planner import PatchPlan, PatchPlanner
+from progress import ProgressTracker, SequentialProgress
+from restore_points import RestorePoint, RestorePointStore
 from web_helper import WebHelper
+import file_operations
 import manifest
 import utils
 
@@ -12,15 +31,43 @@ import utils
 class Logic:
     APP_ID = 813780
 
-    def __init__(self):
-        self.webhook = WebHelper()
+    def __init__(self, manifest_workers: int = 4, download_workers: int = 3, batch_depots: bool = False, store_size: int = 8 * 1024 * 1024 * 1024,
+                 seed_downloads: bool = True, file_workers: int = 8, restore_point_size: int = 8 * 1024 * 1024 * 1024):
+        self.webhook = WebHelper(utils.base_path() / "web_cache")
         # The earliest patch that works was released after direct x update
         # @TODO Try to figure out a way to patch to earlier patches than this: time.struct_time((2020, 2, 17, 0, 0, 0, 0, 48, 0))
         self.download_dir = utils.base_path() / "download"
+        self.staging_dir = utils.base_path() / "staging"
         self.manifest_dir = utils.base_path() / "manifests"
         self.backup_dir = utils.base_path() / "backup"
-        self.patch_list = self.webhook.query_patches()
+        self.store_dir = utils.base_path() / "store"
+        self.index_dir = utils.base_path() / "index"
+        # Maximum number of manifests that are downloaded at the same time
+        self.manifest_workers = manifest_workers
+        # Maximum number of depots that are downloaded at the same time
+        self.download_workers = download_workers
+        # Download all depots with a single DepotDownloader process instead of one process per depot
+        self.batch_depots = batch_depots
+        # The list of the last start is used until it has been refreshed, empty on the very first start
+        self.patch_index = PatchIndex(self.webhook.cached_patch_history() or PatchHistory([]))
         self.depot_downloader_helper = DepotDownloaderHelper()
+        self.manifest_cache = ManifestCache(self.manifest_dir)
+        # Copy the installed versions of modified files to the staging directory so only changed chunks are downloaded
+        self.seed_downloads = seed_downloads
+        # Disk budget for previously seen file contents
+        self.object_store = ObjectStore(self.store_dir, store_size)
+        # Files of the installed version that don't exist in the target version, removed when the patch is applied
+        self.removed_files: list[str] = []
+        self.planner = PatchPlanner(self.patch_index, self.manifest_cache, self.object_store, self.webhook, manifest_workers)
+        self.journal = PatchJournal(utils.base_path() / "journal.json")
+        # Maximum number of file operations running at the same time when backing up, patching and restoring
+        self.file_operations = FileOperationEngine(file_workers)
+        # Disk budget for restore points, the oldest ones are removed first
+        self.restore_point_size = restore_point_size
+        # Combined progress of all running downloads, can be polled or subscribed to
+        self.progress = ProgressTracker()
+
+        self._recover()
 
     def patch(self, username: str, target_version: int) -> None:
         """Start patching the game with the downloaded files.
@@ -37,59 +84,199 @@ class Logic:
             if username == "":
                 raise Exception("Please enter a username")
 
+            self._check_interrupted_patch()
+
             installed_version = utils.get_game_version(self.game_dir)
             if installed_version == target_version:
                 raise Exception("The selected version is already installed")
 
             print("Starting download phase...")
 
-            self._download_patch(username, installed_version, target_version)
-
-            print("Finished downloading files")
-
-            print("Starting backup...")
-
-            self._backup()
-
-            print("Finished backup")
+            downloads = self._plan_patch(username, installed_version, target_version)
 
-            print("Patching files...")
+            print("Downloading and patching files...")
 
-            self._move_patch()
+            self._run_patch(username, downloads, installed_version, target_version)
 
             print("Finished patching files")
         except Exception:
             raise
 
-    def restore(self) -> None:
-        """Restores the game directory using the backed up files and downloaded files.
+    def restore(self, restore_point: RestorePoint | None = None) -> None:
+        """Restores the game directory to the state before the patch of a restore point.
+        All newer restore points are restored as well and removed afterwards.
+
+        Args:
+            restore_point (RestorePoint, optional): The restore point, the newest one if omitted. Defaults to None.
         """
         # Check some stuff
         if not hasattr(self, "game_dir") or self.game_dir is None:
             raise Exception("Please select a game directory")
 
-        if not self.backup_dir.exists():
-            raise Exception("Backup directory doesn't exist")
+        self._check_interrupted_patch()
+
+        points = self.restore_points.list_points(self.game_dir)
+
+        # Backups of older versions of the patcher
+        if len(points) == 0 and len(file_operations.walk(self.backup_dir)) > 0:
+            self._restore_backup_dir()
+            return
 
-        if len(os.listdir(self.backup_dir.absolute())) == 0:
+        if len(points) == 0:
             raise Exception("No backup stored")
 
-        # Remove added files from the path
+        if restore_point is None:
+            restore_point = points[-1]
+
+        index = next((i for i, point in enumerate(points) if point.id == restore_point.id), None)
+        if index is None:
+            raise Exception("Unknown restore point")
+
+        # Oldest first, every restore point has to continue where the previous one ended
+        chain = points[index:]
+        installed_version = utils.get_game_version(self.game_dir)
+
+        if chain[-1].target_version != installed_version or any(point.target_version != next_point.version for point, next_point in zip(chain, chain[1:])):
+            raise Exception("The installed version has been changed since the restore point has been created, cannot restore")
+
+        # Relative name -> hash of the content before the oldest patch, None if the file didn't exist
+        state: dict[str, str | None] = {}
+
+        for point in reversed(chain):
+            state.update((name, None) for name in point.created)
+            state.update(point.files)
+
+        try:
+            print(f"Restoring version {restore_point.version}...")
+
+            self._remove_files(self.game_dir, [name for name, sha in state.items() if sha is None])
+
+            operations = [FileOperation("copy", self.restore_points.object_path(sha), self.game_dir / name, sha) for name, sha in state.items() if sha is not None]
+            hashes = self.file_operations.run(operations, "Restoring files")
+
+            # Restored files have been hashed while copying, they don't have to be hashed again when verifying
+            self.hash_index.add({name: hashes[self.game_dir / name] for name, sha in state.items() if sha is not None})
+
+            for point in chain:
+                self.restore_points.remove(point)
+
+            print("Finished restoring backup")
+        except Exception as e:
+            raise Exception(f"Error restoring files!\n{e}")
+
+    def _restore_backup_dir(self) -> None:
+        """Restore the backup directory left by older versions of the patcher, the patched files are still listed in the download directory.
+        """
         try:
             print("Removing patched files...")
-            utils.remove_patched_files(self.game_dir, self.download_dir, True)
+            self._remove_files(self.game_dir, file_operations.walk(self.download_dir))
             print("Finished removing patched files")
-
-            # Copy backed up files to game path again
-            try:
-                print("Restoring backup...")
-                shutil.copytree(self.backup_dir.absolute(), self.game_dir.absolute(), dirs_exist_ok=True)
-                print("Finished restoring backup")
-            except Exception:
-                raise Exception("Error restoring files!")
         except Exception:
             raise Exception("Error removing files!")
 
+        try:
+            print("Restoring backup...")
+            names = file_operations.walk(self.backup_dir)
+            hashes = self.file_operations.run([FileOperation("copy", self.backup_dir / name, self.game_dir / name) for name in names], "Restoring files")
+
+            # Restored files have been hashed while copying, they don't have to be hashed again when verifying
+            self.hash_index.add({name: hashes[self.game_dir / name] for name in names})
+            print("Finished restoring backup")
+        except Exception:
+            raise Exception("Error restoring files!")
+
+    def get_restore_points(self) -> list[RestorePoint]:
+        """Returns the restore points of the game directory.
+
+        Returns:
+            list[RestorePoint]: The restore points, oldest first
+        """
+        if not hasattr(self, "game_dir") or self.game_dir is None:
+            return []
+
+        return self.restore_points.list_points(self.game_dir)
+
+    def verify(self, username: str, target_version: int, repair: bool = False) -> list[str]:
+        """Compare all files of the game directory with the manifests of the given version and optionally repair them.
+
+        Args:
+            username (str): The username
+            target_version (int): The version to compare against
+            repair (bool, optional): Download and replace all missing or mismatching files. Defaults to False.
+
+        Returns:
+            list[str]: The names of all missing or mismatching files
+        """
+        # Check some stuff
+        if not hasattr(self, "game_dir") or self.game_dir is None:
+            raise Exception("Please select a game directory")
+
+        if username == "":
+            raise Exception("Please enter a username")
+
+        if target_version not in self.patch_index:
+            raise Exception(f"Version {target_version} is unknown")
+
+        self._check_interrupted_patch()
+
+        print("Loading manifests...")
+
+        manifest_ids = list(self.patch_index.depots(target_version).items())
+        manifests = self._load_manifests(username, manifest_ids)
+        depot_files = {}
+
+        for depot_id, manifest_id in manifest_ids:
+            # Directories are listed without a hash
+            files = [(name, size, digest.hex()) for (name, digest, size) in manifests[(depot_id, manifest_id)].files if any(digest)]
+
+            # Depots without any installed file (other languages for example) are not part of this installation
+            if not any((self.game_dir / utils.manifest_path(name)).exists() for (name, _, _) in files):
+                print(f"Depot {depot_id} is not installed, skipping")
+                continue
+
+            depot_files[(depot_id, manifest_id)] = files
+
+        print("Hashing files...")
+
+        reported = 0
+
+        def progress(done: int, total: int) -> None:
+            nonlocal reported
+
+            percent = done * 100 // max(1, total)
+            if percent >= reported + 10:
+                reported = percent
+                print(f"Hashing files: {percent}%")
+
+        hashes = self.hash_index.update([name for files in depot_files.values() for (name, _, _) in files], progress)
+
+        downloads = []
+        mismatched = []
+
+        for (depot_id, manifest_id), files in depot_files.items():
+            invalid = [(name, size, sha) for (name, size, sha) in files if hashes.get(name) != sha]
+
+            if len(invalid) > 0:
+                print(f"Depot {depot_id}: {len(invalid)} missing or modified files")
+                downloads.append((depot_id, manifest_id, invalid))
+                mismatched += [name for (name, _, _) in invalid]
+
+        print(f"Finished verifying files, {len(mismatched)} missing or modified files found")
+
+        if repair and len(mismatched) > 0:
+            # dotnet is required to proceed
+            if not (utils.check_dotnet()):
+                raise Exception("DOTNET Core required but not found!")
+
+            print("Downloading and repairing files...")
+
+            self._prepare_download()
+            self._run_patch(username, downloads, utils.get_game_version(self.game_dir), target_version)
+
+            print("Finished repairing files")
+
+        return mismatched
+
     def set_game_dir(self, dir: pathlib.Path) -> None:
         """Tries to set the game directory, if successful return True. Otherwise return False.
 
@@ -103,37 +290,185 @@ class Logic:
 
         self.game_dir = dir
 
+        # Patched files are renamed into place which requires the work directories to be on the same drive as the game
+        work_dir = self._work_dir(dir)
+        self.download_dir = work_dir / "download"
+        self.staging_dir = work_dir / "staging"
+        self.backup_dir = work_dir / "backup"
+        self.restore_points = RestorePointStore(work_dir / "restore_points", self.restore_point_size)
+
+        # One index per game directory, the file name is derived from the path
+        index_name = hashlib.sha1(str(dir.absolute()).encode()).hexdigest()
+        self.hash_index = HashIndex(dir, self.index_dir / f"{index_name}.json")
+
         print(f"Game directory set to: {dir.absolute()}")
         print(f"Installed version detected: {utils.get_game_version(self.game_dir)}")
 
-    def get_patch_list(self) -> list[dict]:
-        """Returns the patch list.
+    def get_patch_index(self) -> PatchIndex:
+        """Returns the index of the patch list.
 
         Returns:
-            list: The list of documented patches
+            PatchIndex: The index of all documented patches
         """
-        return self.patch_list
+        return self.patch_index
+
+    def refresh_patch_index(self) -> PatchIndex:
+        """Query the current patch list. Unchanged lists are revalidated from the cache.
+
+        Returns:
+            PatchIndex: The index of all documented patches
+        """
+        self.patch_index = PatchIndex(self.webhook.query_patch_history())
+        self.planner.patch_index = self.patch_index
+
+        return self.patch_index
+
+    def plan_patches(self) -> dict[int, PatchPlan]:
+        """Estimate the resources needed to patch to every older version from cached and published changes. No manifests are downloaded.
+
+        Returns:
+            dict[int, PatchPlan]: The plan for every older version keyed by version, empty if no game directory is set
+        """
+        if not hasattr(self, "game_dir") or self.game_dir is None:
+            return {}
+
+        return self.planner.plan_older(utils.get_game_version(self.game_dir), remote=True)
 
     def cancel_downloads(self) -> None:
         """Performs cleanup for logic object.
         """
         self.depot_downloader_helper.cancel_downloads()
 
-    def _download_patch(self, username: str, installed_version: int, target_version: int) -> None:
-        """Download the given patch using the steam account username.
+    def _plan_patch(self, username: str, installed_version: int, target_version: int) -> list[tuple[int, int, list[tuple[str, int, str]]]]:
+        """Determine the files that have to be downloaded for the given patch using the steam account username.
 
         Args:
             username (str): The username
             installed_version (int): The currently installed version
             target_version (int): The target version
+
+        Returns:
+            list: A list of (depot id, manifest id, files) where files is a list of (name, size, hash)
         """
         # dotnet is required to proceed
         if not (utils.check_dotnet()):
             raise Exception("DOTNET Core required but not found!")
 
-        update_list = []
-        tmp_files = []
+        self._prepare_download()
+
+        print("Generating list of changes")
+
+        # One of the two patches is not in the list of patches. Most likely the installed version, cannot patch
+        if installed_version not in self.patch_index or target_version not in self.patch_index:
+            raise Exception("The installed version currently doesn't support downgrading. Please be patient or notify me on GitHub!")
+
+        # Only support patching via filelists to an older version atm
+        if installed_version < target_version:
+            raise Exception("Patching forward is currently unavailable. Please use Steam to get to the latest version and then patch backwards")
+
+        plan = self.planner.plan(installed_version, target_version, remote=True)
+
+        for depot_id in plan.discarded:
+            print(f"Depot {depot_id} doesn't exist in both versions, discarding it")
+
+        # Changes that couldn't be determined otherwise require the manifests
+        missing = [depot for depot in plan.depots if plan.diffs[depot[0]] is None]
+        manifests = self._load_manifests(username, [m for (depot_id, current_manifest_id, target_manifest_id) in missing
+                                                    for m in ((depot_id, current_manifest_id), (depot_id, target_manifest_id))])
+
+        for depot_id, current_manifest_id, target_manifest_id in missing:
+            diff = self._get_diff(manifests[(depot_id, current_manifest_id)], manifests[(depot_id, target_manifest_id)])
+            self.manifest_cache.put_diff(depot_id, current_manifest_id, target_manifest_id, diff)
+            plan.diffs[depot_id] = diff
+
+        self.planner.estimate(plan)
+
+        print(f"Download size: {utils.format_size(plan.download_size)}, disk space needed: {utils.format_size(plan.staging_size + plan.backup_size)}")
+
+        self.planner.check_disk_space(plan, self.download_dir.parent, self.game_dir)
+
+        downloads = []
+
+        for depot_id, current_manifest_id, target_manifest_id in plan.depots:
+            diff = plan.diffs[depot_id]
+            changes = self._get_filelist_from_diff(diff)
+
+            print(f"Depot {depot_id}: {len(changes)} files to download ({utils.format_size(sum(size for (_, size, _) in changes))}), "
+                  f"{len(diff.added)} files to remove ({utils.format_size(diff.added_bytes)})")
+
+            downloads.append((depot_id, target_manifest_id, changes))
+            # Files that have been added since the target version
+            self.removed_files += list(diff.added)
+
+        return downloads
 
+    def _run_patch(self, username: str, downloads: list[tuple[int, int, list[tuple[str, int, str]]]], version: int, target_version: int) -> None:
+        """Download, backup and apply the given files. Every depot is backed up and applied as soon as it has been downloaded,
+        while the remaining depots are still downloading. If anything fails all depots that have been applied are rolled back.
+
+        Args:
+            username (str): The username
+            downloads (list): A list of (depot id, manifest id, files) where files is a list of (name, size, hash)
+            version (int): The installed version
+            target_version (int): The version that will be installed
+        """
+        record = self._begin_backup(version, target_version)
+        downloaded: queue.Queue[list[str] | None] = queue.Queue()
+        errors = []
+
+        def apply_downloaded():
+            while (names := downloaded.get()) is not None:
+                # Drain the queue after a failure
+                if len(errors) > 0:
+                    continue
+
+                try:
+                    self._backup_and_apply(record, names)
+                except Exception as e:
+                    errors.append(e)
+                    # Remaining downloads can't be applied anymore
+                    self.depot_downloader_helper.cancel_downloads()
+
+        worker = threading.Thread(target=apply_downloaded)
+        worker.start()
+
+        try:
+            try:
+                self._download_files(username, downloads, downloaded.put)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                downloaded.put(None)
+                worker.join()
+                # A failed apply cancels the downloads even if all of them are done already, later manifest downloads must still work
+                self.depot_downloader_helper.reset()
+
+            # Report the error that caused the cancellation
+            if len(errors) > 0:
+                raise errors[0]
+
+            # Files that are removed by the patch are not touched by any depot, they are backed up last
+            self._backup_files(record, self.removed_files)
+
+            # Decided before anything is moved out of the backup, the backup can't tell anymore once the restore point takes its files
+            record.created = [name for name in record.files if name not in record.hashes]
+            record.state = "apply"
+            self.journal.write(record)
+
+            self._finish_patch(record)
+
+            if len(self.removed_files) > 0:
+                print(f"Removed {len(self.removed_files)} files that don't exist in the target version")
+        except Exception:
+            if record.state == "backup":
+                print("Reverting patched files...")
+                self._rollback(record)
+
+            raise
+
+    def _prepare_download(self) -> None:
+        """Remove files of previous downloads and create empty folders.
+        """
         # Remove previous download folder if it exists
         # Create empty folders afterwards
         if self.download_dir.exists():
@@ -143,194 +478,601 @@ class Logic:
                 raise Exception("Error removing previous download directory")
 
         self.download_dir.mkdir()
+        self.removed_files = []
+
+        # Remove previous staging folder if it exists
+        if self.staging_dir.exists():
+            try:
+                shutil.rmtree(self.staging_dir.absolute())
+            except Exception:
+                raise Exception("Error removing previous staging directory")
+
+    def _download_files(self, username: str, downloads: list[tuple[int, int, list[tuple[str, int, str]]]],
+                        on_downloaded: Callable[[list[str]], None] | None = None) -> None:
+        """Download the given files of several depots to the download directory.
+        Files whose content is available locally are not downloaded again.
+
+        Args:
+            username (str): The username
+            downloads (list): A list of (depot id, manifest id, files) where files is a list of (name, size, hash)
+            on_downloaded (Callable[[list[str]], None], optional): Called with the names of all files of a depot once they are in the download directory,
+                possibly from another thread. Defaults to None.
+        """
+        if on_downloaded is None:
+            def on_downloaded(names: list[str]) -> None:
+                pass
+
+        update_list = []
+        tmp_files = []
+        reused_files = 0
+        reused_size = 0
+
+        for depot_id, manifest_id, files in downloads:
+            changes = []
+
+            # Take files from the local store if their content has been seen before, only download the rest
+            for name, size, sha in files:
+                # Directories are listed without a hash, they are only created
+                if int(sha, 16) == 0:
+                    (self.download_dir / utils.manifest_path(name)).mkdir(parents=True, exist_ok=True)
+                elif self.object_store.extract(sha, self.download_dir / utils.manifest_path(name)):
+                    reused_files += 1
+                    reused_size += size
+                else:
+                    changes.append((name, size, sha))
+
+            # Files have changed, store changes to temp file and add to update list
+            if len(changes) > 0:
+                # Create temp file
+                tmp = tempfile.NamedTemporaryFile(mode="w", delete=False)
+
+                # Store file name for deletion later on
+                tmp_files.append(tmp.name)
+
+                # Write content to file
+                tmp.write("\n".join(name for (name, _, _) in changes))
+                tmp.close()
+
+                # Add update element to list
+                update_list.append({'depot_id': depot_id, 'manifest_id': manifest_id, 'filelist': tmp.name, 'changes': changes,
+                                    'size': sum(size for (_, size, _) in changes), 'names': [name for (name, _, _) in files]})
+            else:
+                # Everything is available locally already
+                on_downloaded([name for (name, _, _) in files])
+
+        if reused_files > 0:
+            print(f"Reusing {reused_files} files ({reused_size} bytes) from local store")
+
+        print("Downloading files")
+
+        if self.batch_depots and len(update_list) > 1:
+            # One process for all depots, the filelist is shared by all depots
+            tmp = tempfile.NamedTemporaryFile(mode="w", delete=False)
+            tmp_files.append(tmp.name)
+
+            for element in update_list:
+                with open(element['filelist']) as f:
+                    tmp.write(f.read() + "\n")
+            tmp.close()
+
+            depots = [(element['depot_id'], element['manifest_id']) for element in update_list]
+            names = [name for element in update_list for (name, _, _) in element['changes']]
+            job_name = f"depots {', '.join(str(depot_id) for (depot_id, _) in depots)}"
+            jobs = [DownloadJob(job_name, sum(element['size'] for element in update_list),
+                                functools.partial(self._run_download, job_name, update_list, on_downloaded,
+                                                  functools.partial(self._download_depots, username, depots, tmp.name, self.staging_dir / "batch", names)))]
+        else:
+            # Download all necessary updates concurrently, stops if a download didn't succeed
+            jobs = [DownloadJob(f"depot {element['depot_id']}", element['size'],
+                                functools.partial(self._run_download, f"depot {element['depot_id']}", [element], on_downloaded,
+                                                  functools.partial(self._download_depot, username, element['depot_id'], element['manifest_id'],
+                                                                    element['filelist'], [name for (name, _, _) in element['changes']])))
+                    for element in update_list]
+
+        self.progress.reset()
+        for job in jobs:
+            self.progress.add(job.name, job.size)
+
+        try:
+            self.depot_downloader_helper.reset()
+            DownloadScheduler(self.depot_downloader_helper, self.download_workers).run(jobs)
+        finally:
+            # Remove created temp files
+            for tmp in tmp_files:
+                os.unlink(tmp)
+
+        self.object_store.evict()
 
-        # Remove previous manifests folder if it exists
+    def _run_download(self, name: str, elements: list[dict], on_downloaded: Callable[[list[str]], None], download: Callable[..., None]) -> None:
+        """Run a download of one or more elements of the update list and hand over the downloaded depots.
+
+        Args:
+            name (str): The name of the download as reported in its progress
+            elements (list[dict]): The elements of the update list that are downloaded
+            on_downloaded (Callable[[list[str]], None]): Called with the names of all files of every downloaded depot
+            download (Callable[..., None]): Runs the download, takes callbacks for its login and its progress as keyword arguments on_login and on_progress
+        """
+        on_progress = functools.partial(self.progress.update, name)
+
+        # A batch reports every depot from 0% again, in the order they have been passed
+        if len(elements) > 1:
+            on_progress = SequentialProgress([element['size'] for element in elements], on_progress).update
+
+        # Time spent waiting for the login or at Steam Guard prompts is not part of the download
+        download(on_login=functools.partial(self.progress.start, name), on_progress=on_progress)
+        self.progress.finish(name)
+
+        for element in elements:
+            # Remember downloaded contents for later patches
+            for name, _, sha in element['changes']:
+                path = self.download_dir / utils.manifest_path(name)
+
+                if path.is_file():
+                    self.object_store.add(path, sha)
+
+            on_downloaded(element['names'])
+
+    def _finish_patch(self, record: JournalRecord) -> None:
+        """Move the downloaded files of a journaled patch into place and create its restore point if it has one.
+        Every step can be repeated, an interrupted patch is completed by calling this again.
+
+        Args:
+            record (JournalRecord): The record of the patch
+        """
+        game_dir = pathlib.Path(record.game_dir)
+        backup_dir = pathlib.Path(record.backup_dir)
+
+        self._apply_files(game_dir, pathlib.Path(record.download_dir), record.files)
+        self._remove_files(game_dir, record.removed)
+
+        # Repairs only use the backup to be able to roll back
+        if record.restore_point != "":
+            # Journals of older versions don't list the created files, every backed up file has been hashed
+            created = record.created if record.created is not None else [name for name in record.files if name not in record.hashes]
+
+            restore_points = RestorePointStore(backup_dir.parent / "restore_points", self.restore_point_size)
+            point = restore_points.create(record.restore_point, game_dir, record.version, record.target_version, backup_dir, record.hashes, created)
+
+            # Remember the replaced contents. Backups are moved back into the game directory on a rollback, so they are only
+            # linked into the store once they belong to a restore point, whose files are never modified or moved out again
+            for sha in set(point.files.values()):
+                path = restore_points.object_path(sha)
+
+                if path.is_file():
+                    self.object_store.add(path, sha, link=True)
+
+            self.object_store.evict()
+
+        shutil.rmtree(backup_dir.absolute(), ignore_errors=True)
+        self.journal.clear()
+
+    def _apply_files(self, game_dir: pathlib.Path, download_dir: pathlib.Path, names: list[str]) -> None:
+        """Move downloaded files into the game directory and create the directories of the patch, empty ones included.
+        Files that have already been moved are skipped.
+
+        Args:
+            game_dir (pathlib.Path): The game directory
+            download_dir (pathlib.Path): The download directory
+            names (list[str]): The relative names of the files and directories
+        """
+        operations = []
+
+        for name in names:
+            source = download_dir / utils.manifest_path(name)
+            target = game_dir / utils.manifest_path(name)
+
+            if source.is_file():
+                operations.append(FileOperation("move", source, target))
+            elif source.is_dir() and not target.is_dir():
+                operations.append(FileOperation("mkdir", None, target))
+
+        self.file_operations.run(operations, "Patching files")
+
+    def _remove_files(self, game_dir: pathlib.Path, names: list[str]) -> None:
+        """Remove the given files from the game directory, directories are only removed once they are empty.
+        Parent directories that are empty afterwards are removed as well.
+
+        Args:
+            game_dir (pathlib.Path): The game directory
+            names (list[str]): The relative names of the files and directories
+        """
+        directories = set()
+        operations = []
+
+        for name in names:
+            path = game_dir / utils.manifest_path(name)
+
+            if path.is_dir():
+                directories.add(path)
+            elif path.is_file():
+                operations.append(FileOperation("remove", None, path))
+                directories.update(parent for parent in path.parents if parent != game_dir and game_dir in parent.parents)
+
+        self.file_operations.run(operations, "Removing files")
+
+        # Nested directories first
+        for path in sorted(directories, key=lambda p: len(p.parts), reverse=True):
+            if path.is_dir() and not any(path.iterdir()):
+                path.rmdir()
+
+    def _begin_backup(self, version: int, target_version: int) -> JournalRecord:
+        """Prepare an empty backup directory and start the journal of a patch.
+
+        Args:
+            version (int): The installed version
+            target_version (int): The version that will be installed
+
+        Returns:
+            JournalRecord: The record of the patch
+        """
+        # Remove previous backup folder if it exists
         # Create empty folders afterwards
-        if self.manifest_dir.exists():
+        if self.backup_dir.exists():
             try:
-                shutil.rmtree(self.manifest_dir.absolute())
+                shutil.rmtree(self.backup_dir.absolute())
             except Exception:
-                raise Exception("Error removing previous manifest directory")
+                raise Exception("Error removing previous backup directory")
+        self.backup_dir.mkdir(parents=True)
 
-        self.manifest_dir.mkdir()
+        # Installed files are moved into the backup, an interrupted patch is rolled back on the next start.
+        # A repair keeps the installed version, the files it replaces are broken and don't get a restore point
+        restore_point = f"{time.time_ns()}_{version}_{target_version}" if version != target_version else ""
+        record = JournalRecord("backup", str(self.game_dir.absolute()), str(self.download_dir.absolute()), str(self.backup_dir.absolute()),
+                               removed=self.removed_files, version=version, target_version=target_version, restore_point=restore_point)
+        self.journal.write(record)
 
-        print("Generating list of changes")
+        return record
 
-        # Filter list of patches for current and target version
-        filtered_patches = list(filter(lambda x: x["version"] == installed_version or x["version"] == target_version, self.patch_list))
+    def _backup_and_apply(self, record: JournalRecord, names: list[str]) -> None:
+        """Backup the installed versions of downloaded files and move the downloaded files into place.
 
-        # One of the two patches is not in the list of patches. Most likely the installed version, cannot patch
-        if len(filtered_patches) != 2:
-            raise Exception("The installed version currently doesn't support downgrading. Please be patient or notify me on GitHub!")
+        Args:
+            record (JournalRecord): The record of the patch
+            names (list[str]): The names of the downloaded files
+        """
+        def is_patched(name: str) -> bool:
+            source = self.download_dir / utils.manifest_path(name)
 
-        # Store current and target patch
-        current_patch = list(filter(lambda x: x["version"] == installed_version, self.patch_list))[0]
-        target_patch = list(filter(lambda x: x["version"] == target_version, filtered_patches))[0]
+            # Directories that exist already are not part of the patch, a rollback or restore must not remove them
+            return source.is_file() or (source.is_dir() and not (self.game_dir / utils.manifest_path(name)).is_dir())
 
-        # Only support patching via filelists to an older version atm
-        if installed_version < target_version:
-            raise Exception("Patching forward is currently unavailable. Please use Steam to get to the latest version and then patch backwards")
+        names = [name.replace("\\", "/") for name in names if is_patched(name)]
 
-        # Iterate depots of current and target patch together
-        for current_depot, target_depot in zip(current_patch["depots"], target_patch["depots"]):
-            # Check if depot id changes (VCRedist for example does change sometimes)
-            # (Temporary?) solution just skip non-matching depot since old depots are no longer available and hope it still works
-            if current_depot["depot_id"] == target_depot["depot_id"]:
-                depot_id = current_depot["depot_id"]
-                current_manifest_id = current_depot["manifest_id"]
-                target_manifest_id = target_depot["manifest_id"]
+        # Directories replace nothing, there is nothing to back up
+        self._backup_files(record, [name for name in names if (self.download_dir / utils.manifest_path(name)).is_file()])
 
-                changes = self._get_filelist(username, depot_id, current_manifest_id, target_manifest_id)
+        # Written ahead so a rollback knows which files have been patched
+        record.files += names
+        self.journal.write(record)
 
-                # Files have changed, store changes to temp file and add to update list
-                if changes is not None:
-                    # Create temp file
-                    tmp = tempfile.NamedTemporaryFile(mode="w", delete=False)
+        self._apply_files(self.game_dir, self.download_dir, names)
 
-                    # Store file name for deletion later on
-                    tmp_files.append(tmp.name)
+    def _backup_files(self, record: JournalRecord, names: list[str]) -> None:
+        """Backup the given files of the game directory if they exist.
 
-                    # Write content to file
-                    tmp.write("\n".join(changes))
-                    tmp.close()
+        Args:
+            record (JournalRecord): The record of the patch
+            names (list[str]): The relative names of the files
+        """
+        # Only files that changed since they were last indexed are hashed
+        hashes = self.hash_index.update(names)
+        record.hashes.update(hashes)
 
-                    # Add update element to list
-                    update_list.append({'depot_id': depot_id, 'manifest_id': target_manifest_id, 'filelist': tmp.name})
-            else:
-                print(f"Depot ID not matching, discarding pair ({current_depot['depot_id']}, {target_depot['depot_id']})")
+        # Files are moved into the backup since they are replaced anyway
+        operations = [FileOperation("backup", self.game_dir / utils.manifest_path(name), self.backup_dir / utils.manifest_path(name))
+                      for name in names if (self.game_dir / utils.manifest_path(name)).is_file()]
 
-        print("Downloading files")
+        self.file_operations.run(operations, "Backing up files")
 
-        # Loop all necessary updates
-        for element in update_list:
-            # Stop if a download didn't succeed
-            self._download_depot(username, element['depot_id'], element['manifest_id'], element['filelist'])
+    def _rollback(self, record: JournalRecord) -> None:
+        """Undo a patch that has not been applied completely. Backed up files are moved back and files created by the patch are removed.
 
-        # Remove created temp files
-        for tmp in tmp_files:
-            os.unlink(tmp)
+        Args:
+            record (JournalRecord): The record of the patch
+        """
+        game_dir = pathlib.Path(record.game_dir)
+        backup_dir = pathlib.Path(record.backup_dir)
+        backed_up = file_operations.walk(backup_dir)
+
+        self._remove_files(game_dir, list(set(record.files).difference(backed_up)))
+        self.file_operations.run([FileOperation("move", backup_dir / name, game_dir / name) for name in backed_up], "Moving files back")
+
+        self.journal.clear()
 
-    def _move_patch(self) -> None:
-        """Move downloaded patch files to game directory.
+    def has_interrupted_patch(self) -> bool:
+        """Check if a patch has been interrupted and could not be recovered yet.
+
+        Returns:
+            bool: True if the journal still contains a record
+        """
+        return self.journal.load() is not None
+
+    def recover(self) -> None:
+        """Undo or complete a patch that has been interrupted, for example by a crash or by closing the application.
+
+        Raises:
+            Exception: If the patch could not be recovered, the journal is kept so recovering can be retried
         """
+        record = self.journal.load()
+
+        if record is None:
+            return
+
         try:
-            shutil.copytree(self.download_dir.absolute(), self.game_dir.absolute(), dirs_exist_ok=True)
-        except Exception:
-            raise
+            match record.state:
+                case "backup":
+                    print("The previous patch has been interrupted, reverting patched files...")
+
+                    self._rollback(record)
+
+                    print("Finished reverting patched files")
+                case "apply":
+                    print("The previous patch has been interrupted while patching files, completing it...")
+
+                    self._finish_patch(record)
+
+                    print("Finished patching files")
+        except Exception as e:
+            raise Exception(f"Could not recover the interrupted patch: {e}")
 
-    def _backup(self) -> None:
-        """Backup game folder and in current directory.
+    def _recover(self) -> None:
+        """Try to recover an interrupted patch on start-up. A failure is only reported, recovering can be retried with recover().
         """
         try:
-            # Remove previous backup folder if it exists
-            # Create empty folders afterwards
-            if self.backup_dir.exists():
+            self.recover()
+        except Exception as e:
+            print(e)
+
+    def _check_interrupted_patch(self) -> None:
+        """Make sure no interrupted patch is pending. Its backup still holds the original files and must not be replaced by a new patch.
+
+        Raises:
+            Exception: If a patch has been interrupted and could not be recovered
+        """
+        if self.has_interrupted_patch():
+            raise Exception("The previous patch has been interrupted and could not be recovered yet, please retry recovering it first")
+
+    def _work_dir(self, game_dir: pathlib.Path) -> pathlib.Path:
+        """Get the directory for downloads and backups of a game directory. It has to be on the same drive as the game directory.
+
+        Args:
+            game_dir (pathlib.Path): The game directory
+
+        Returns:
+            pathlib.Path: The work directory
+        """
+        if os.stat(utils.base_path()).st_dev == os.stat(game_dir).st_dev:
+            return utils.base_path()
+
+        work_dir = game_dir.parent / ".aoe2de_patcher"
+
+        try:
+            work_dir.mkdir(exist_ok=True)
+        except OSError as e:
+            print(f"Could not create work directory next to the game directory, patching will be slower: {e}")
+            return utils.base_path()
+
+        return work_dir
+
+    def _load_manifests(self, username: str, manifests: list[tuple[int, int]]) -> dict[tuple[int, int], manifest.Manifest]:
+        """Load the given manifests from the cache and download the ones that are not cached yet.
+
+        Args:
+            username (str): The username
+            manifests (list[tuple[int, int]]): A list of (depot id, manifest id) pairs
+
+        Returns:
+            dict: The parsed manifests keyed by (depot id, manifest id)
+        """
+        result = {}
+        missing = []
+
+        for depot_id, manifest_id in manifests:
+            cached = self.manifest_cache.get_manifest(depot_id, manifest_id)
+
+            if cached is None:
+                missing.append((depot_id, manifest_id))
+            else:
+                result[(depot_id, manifest_id)] = cached
+
+        if len(missing) > 0:
+            download_dir = self.manifest_dir / "download"
+            download_dir.mkdir(exist_ok=True)
+            tmp_dir = pathlib.Path(tempfile.mkdtemp(dir=download_dir))
+
+            try:
+                self._download_manifests(username, missing, tmp_dir)
+
+                # Parse downloaded manifests and store them in the cache
+                for depot_id, manifest_id in missing:
+                    parsed = manifest.read_manifest(tmp_dir / f"manifest_{depot_id}_{manifest_id}.txt")
+                    self.manifest_cache.put_manifest(parsed)
+
+                    result[(depot_id, manifest_id)] = parsed
+            finally:
+                shutil.rmtree(tmp_dir.absolute(), ignore_errors=True)
+
+        return result
+
+    def _download_manifests(self, username: str, manifests: list[tuple[int, int]], dir: pathlib.Path) -> None:
+        """Download several manifests in parallel using a bounded amount of DepotDownloader processes.
+        Manifests of different depots are batched into a single process to only pay start up and login once.
+
+        Args:
+            username (str): The username
+            manifests (list[tuple[int, int]]): A list of (depot id, manifest id) pairs
+            dir (pathlib.Path): The directory the manifest files will be placed in
+
+        Raises:
+            ConnectionError: If one or more manifests could not be downloaded, lists the error of every failed batch once
+        """
+        errors = []
+        batches: list[list[tuple[int, int]]] = []
+
+        # Remove duplicates but keep the order
+        manifests = list(dict.fromkeys(manifests))
+
+        # A process can only download one manifest per depot
+        for depot_id, manifest_id in manifests:
+            batch = next((b for b in batches if all(depot_id != other_depot_id for (other_depot_id, _) in b)), None)
+
+            if batch is None:
+                batches.append([(depot_id, manifest_id)])
+            else:
+                batch.append((depot_id, manifest_id))
+
+        with ThreadPoolExecutor(max_workers=max(1, self.manifest_workers)) as executor:
+            futures = {executor.submit(self._download_manifest_batch, username, batch, dir / str(i)): batch
+                       for i, batch in enumerate(batches)}
+
+            for future in as_completed(futures):
                 try:
-                    shutil.rmtree(self.backup_dir.absolute())
-                except Exception:
-                    raise Exception("Error removing previous backup directory")
-            self.backup_dir.mkdir()
+                    future.result()
+                except Exception as e:
+                    # A process fails as a whole, its error can't be attributed to a single depot
+                    depots = ", ".join(f"{depot_id} (manifest {manifest_id})" for depot_id, manifest_id in futures[future])
+                    errors.append(f"Depots {depots}: {e}")
 
-            utils.backup_files(self.game_dir, self.download_dir, self.backup_dir, True)
-        except Exception:
-            raise
+        if len(errors) > 0:
+            raise ConnectionError("Error downloading manifests\n" + "\n".join(errors))
+
+        # Move manifest files out of the batch directories
+        for i, batch in enumerate(batches):
+            for depot_id, manifest_id in batch:
+                os.replace(dir / str(i) / f"manifest_{depot_id}_{manifest_id}.txt", dir / f"manifest_{depot_id}_{manifest_id}.txt")
 
-    def _download_manifest(self, username: str, depot_id: int, manifest_id: int) -> None:
-        """Download a specific manifest from the given depot using the given credentials.
+    def _download_manifest_batch(self, username: str, manifests: list[tuple[int, int]], dir: pathlib.Path) -> None:
+        """Download specific manifests of several depots with a single process using the given credentials.
 
         Args:
             username (str): The username
-            depot_id (int): The selected depot
-            manifest_id (int): The manifest id for the depot
+            manifests (list[tuple[int, int]]): A list of (depot id, manifest id) pairs, every depot may only be contained once
+            dir (pathlib.Path): The directory the manifest files will be placed in
 
         Raises:
             ConnectionError: If there was an error during authentication
         """
-        args = ["-app", str(self.APP_ID),
-                "-depot", str(depot_id),
-                "-manifest", str(manifest_id),
-                "-username", username,
-                "-remember-password",
-                "-dir", str(self.manifest_dir),
-                "-manifest-only"]
+        args = ["-app", str(self.APP_ID)]
+        args += ["-depot"] + [str(depot_id) for (depot_id, _) in manifests]
+        args += ["-manifest"] + [str(manifest_id) for (_, manifest_id) in manifests]
+        args += ["-username", username,
+                 "-remember-password",
+                 "-dir", str(dir),
+                 "-manifest-only"]
 
         self.depot_downloader_helper.execute(args)
 
-    def _download_depot(self, username: str, depot_id: int, manifest_id: int, filelist: str) -> None:
+    def _download_depot(self, username: str, depot_id: int, manifest_id: int, filelist: str, seed: list[str] | None = None,
+                        on_login: Callable[[], None] | None = None, on_progress: Callable[[float], None] | None = None) -> None:
         """Download a specific depot using the manifest id from steam using the given credentials.
+        The files are downloaded into a separate staging directory per depot and moved to the download directory afterwards.
 
         Args:
             username (str): The username
             depot_id (int): The selected depot
             manifest_id (int): The manifest id for the depot
             filelist (str): The name of the file used as filelist
+            seed (list[str], optional): Files of the filelist whose installed versions may be used to seed the download. Defaults to None.
+            on_login (Callable[[], None], optional): Called once the process has logged in and starts downloading. Defaults to None.
+            on_progress (Callable[[float], None], optional): Called with the fraction of the download that is done. Defaults to None.
 
         Raises:
             ConnectionError: If there was an error during authentication
         """
-        args = ["-app", str(self.APP_ID),
-                "-depot", str(depot_id),
-                "-manifest", str(manifest_id),
-                "-username", username,
-                "-remember-password",
-                "-dir", str(self.download_dir),
-                "-filelist", filelist]
+        self._download_depots(username, [(depot_id, manifest_id)], filelist, self.staging_dir / str(depot_id), seed, on_login, on_progress)
 
-        self.depot_downloader_helper.execute(args)
-
-    def _get_filelist(self, username: str, depot_id: int, current_manifest_id: int, target_manifest_id: int) -> list[str] | None:
-        """Get a list of all files that have been removed or modified between the current and target version.
+    def _download_depots(self, username: str, depots: list[tuple[int, int]], filelist: str, staging_dir: pathlib.Path, seed: list[str] | None = None,
+                         on_login: Callable[[], None] | None = None, on_progress: Callable[[float], None] | None = None) -> None:
+        """Download several depots with a single process using the given credentials.
+        The files are downloaded into the staging directory and moved to the download directory afterwards.
 
         Args:
             username (str): The username
-            depot_id (int): The selected depot
-            current_manifest_id (int): The current manifest id for the depot
-            target_manifest_id (id): The target manifest id for the depot
+            depots (list[tuple[int, int]]): A list of (depot id, manifest id) pairs
+            filelist (str): The name of the file used as filelist, it applies to all depots
+            staging_dir (pathlib.Path): The directory used for the download, must not be shared with other processes
+            seed (list[str], optional): Files of the filelist whose installed versions may be used to seed the download. Defaults to None.
+            on_login (Callable[[], None], optional): Called once the process has logged in and starts downloading. Defaults to None.
+            on_progress (Callable[[float], None], optional): Called with the fraction of the download that is done. Defaults to None.
 
-        Returns:
-            list: A list of changed filenames
+        Raises:
+            ConnectionError: If there was an error during authentication
         """
-        # Only need to check for changes if manifest changed
-        if current_manifest_id == target_manifest_id:
-            return None
+        if self.seed_downloads and seed is not None:
+            self._seed_staging(staging_dir, seed)
+
+        args = ["-app", str(self.APP_ID)]
+        args += ["-depot"] + [str(depot_id) for (depot_id, _) in depots]
+        args += ["-manifest"] + [str(manifest_id) for (_, manifest_id) in depots]
+        args += ["-username", username,
+                 "-remember-password",
+                 "-dir", str(staging_dir),
+                 "-filelist", filelist]
+
+        self.depot_downloader_helper.execute(args, on_login, on_progress)
 
-        removed = []
-        modified = []
+        # DepotDownloader keeps its own state in the staging directory, it must not end up in the game directory
+        utils.move_dir_contents(staging_dir, self.download_dir, ignore={".DepotDownloader"})
+        shutil.rmtree(staging_dir.absolute(), ignore_errors=True)
 
-        # Download manifests
-        self._download_manifest(username, depot_id, current_manifest_id)
-        self._download_manifest(username, depot_id, target_manifest_id)
+    def _seed_staging(self, staging_dir: pathlib.Path, names: list[str]) -> None:
+        """Copy the installed versions of the given files to the staging directory.
+        DepotDownloader validates existing files chunk by chunk and only downloads the chunks that differ.
 
-        # Read manifest files
-        current_manifest = manifest.read_manifest(self.manifest_dir / f"manifest_{depot_id}_{current_manifest_id}.txt")
-        target_manifest = manifest.read_manifest(self.manifest_dir / f"manifest_{depot_id}_{target_manifest_id}.txt")
+        Args:
+            staging_dir (pathlib.Path): The staging directory of the download
+            names (list[str]): The file names as listed in the manifest
+        """
+        seeded = 0
 
-        # Initialize file sets
-        current_set = set(current_manifest.files)
-        target_set = set(target_manifest.files)
+        for name in names:
+            source = self.game_dir / utils.manifest_path(name)
+            target = staging_dir / utils.manifest_path(name)
 
-        # Find all removed files (Result contains removed files and files with different hash)
-        diff_removed = list(target_set.difference(current_set))
-        diff_removed_names = set([x[0] for x in diff_removed])
+            if not source.is_file():
+                continue
 
-        # Find all added files (Result contains added files and files with different hash)
-        diff_added = list(current_set.difference(target_set))
-        diff_added_names = set([x[0] for x in diff_added])
+            target.parent.mkdir(parents=True, exist_ok=True)
 
-        # Find all removed files (Remove files with same name but different hash)
-        removed = set.difference(diff_removed_names, diff_added_names)
+            # Must never be a hardlink, DepotDownloader modifies the file in place
+            utils.clone_file(source, target)
+            seeded += 1
 
-        # Find all modified files (Retain files with same name but different hash)
-        modified = set.intersection(diff_removed_names, diff_added_names)
+        if seeded > 0:
+            print(f"Seeded {seeded} files into {staging_dir}")
 
+    def _get_diff(self, current_manifest: manifest.Manifest, target_manifest: manifest.Manifest) -> manifest.ManifestDiff:
+        """Get the changes from the target version to the current version.
+
+        Args:
+            current_manifest (manifest.Manifest): The manifest of the current version
+            target_manifest (manifest.Manifest): The manifest of the target version
+
+        Returns:
+            manifest.ManifestDiff: The added, removed and modified files since the target version
+        """
+        # The target version is the older one
+        return manifest.diff_manifests(target_manifest, current_manifest)
+
+    def _get_filelist_from_diff(self, diff: manifest.ManifestDiff) -> list[tuple[str, int, str]]:
+        """Get a list of all files that have to be downloaded to revert a diff.
+
+        Args:
+            diff (manifest.ManifestDiff): The changes from the target version to the current version
+
+        Returns:
+            list: A list of changed filenames and their size and hash in the target version
+        """
         changes = []
 
-        changes += removed
-        changes += modified
+        # Files that have been removed since the target version
+        changes += [(name, size, sha) for name, (size, sha) in diff.removed.items()]
+        # Files that have been modified since the target version
+        changes += [(name, size, sha) for name, ((size, sha), _) in diff.modified.items()]
 
         return changes
 
-    def _get_filelist_current(self, username: str, password: str, depot_id: int, manifest_id: int) -> list[str]:
+    def _get_filelist_current(self, username: str, depot_id: int, manifest_id: int) -> list[tuple[str, bytes, int]]:
         """Get a list of all files current files of a depot.
 
         Args:
@@ -341,10 +1083,6 @@ class Logic:
         Returns:
             list: A list of current file names for the depot
         """
-        # Download manifests
-        self._download_manifest(username, depot_id, manifest_id)
-
-        # Read manifest files
-        current_manifest = manifest.read_manifest(self.manifest_dir / f"manifest_{depot_id}_{manifest_id}.txt")
+        current_manifest = self._load_manifests(username, [(depot_id, manifest_id)])[(depot_id, manifest_id)]
 
         return current_manifest.files
@@ -1,6 +1,9 @@
+from array import array
 from dataclasses import dataclass
+from operator import itemgetter
 import pathlib
-import re
+import struct
+import sys
 from typing import Any
 
 
@@ -13,7 +16,14 @@ class Manifest():
     num_chunks: int
     size_disk: int
     size_compressed: int
-    files: list[str]
+    # (name, 20 byte SHA-1 digest, size) for every file, names are interned
+    files: list[tuple[str, bytes, int]]
+
+
+# Magic, format version, depot, id, number of files, number of chunks, size on disk, size compressed, length of date string
+BINARY_HEADER = struct.Struct("<4sHIQIIQQI")
+BINARY_MAGIC = b"AOEM"
+BINARY_VERSION = 1
 
 
 def read_manifest(file: pathlib.Path) -> Manifest:
@@ -25,71 +35,285 @@ def read_manifest(file: pathlib.Path) -> Manifest:
     Returns:
         Manifest: The parsed manifest object
     """
-    def expectMatch(pattern: str, line: str) -> re.Match[str]:
-        match = re.match(pattern, line)
-
-        if match is None:
-            raise ValueError(f"Could not match pattern '{pattern}' against line '{line}'")
-
-        return match
-
-    with open(file, "r") as f:
-        depot = 0
-        id = 0
-        date = 0
-        num_files = 0
-        num_chunks = 0
-        size_disk = 0
-        size_compressed = 0
-        files = []
-
-        try:
-            # First line contains depot id
-            line = f.readline()
-            depot = int(expectMatch(r".* (\d+)", line).groups()[0])
-
-            # Second lines is empty
-            # Third contains manifest id and date
-            line = f.readline()
-            line = f.readline()
-            groups = expectMatch(r".* : (\d+) \/ (.+)", line).groups()
-            id = int(groups[0])
-            date = str(groups[1])    # (Temporary) workaround since date isn't used anyways.
-            # Date format seems to be localized... @TODO find a way to universally parse date string
-            # date = time.mktime(time.strptime(groups[1], "%d.%m.%Y %H:%M:%S"))
-
-            # Fourth line contains number of files
-            line = f.readline()
-            groups = expectMatch(r".* : (\d+)", line).groups()
-            num_files = int(groups[0])
-
-            # Fifth line contains number of chunks
-            line = f.readline()
-            groups = expectMatch(r".* : (\d+)", line).groups()
-            num_chunks = int(groups[0])
-
-            # Sixth line contains size on disk
-            line = f.readline()
-            groups = expectMatch(r".* : (\d+)", line).groups()
-            size_disk = int(groups[0])
-
-            # Seventh line contains size compressed
-            line = f.readline()
-            groups = expectMatch(r".* : (\d+)", line).groups()
-            size_compressed = int(groups[0])
-
-            # Eighth line is empty
-            # Ninth line is empty
-            # Tenth line contains headers
-            # Eleventh line until EOF contains one file per line
-            line = f.readline()
-            line = f.readline()
-            line = f.readline()
-            while line := f.readline():
-                # Extract file hash and name
-                match = expectMatch(r"\s+\d+\s+\d+\s+(?P<hash>.{40})\s+\d+\s+(?P<name>.+)", line)
-                files.append((match.group("name"), match.group("hash")))
-
-            return Manifest(depot, id, date, num_files, num_chunks, size_disk, size_compressed, files)
-        except ValueError:
-            raise
+    def header_value(line: str) -> str:
+        key, separator, value = line.partition(" : ")
+
+        if not separator:
+            raise ValueError(f"Could not parse header line '{line}'")
+
+        return value.strip()
+
+    with open(file, "r", encoding="utf-8") as f:
+        lines = f.read().splitlines()
+
+    try:
+        # First line contains depot id
+        depot = int(lines[0].split()[-1])
+
+        # Second lines is empty
+        # Third contains manifest id and date
+        id, _, date = header_value(lines[2]).partition(" / ")
+        id = int(id)
+        # (Temporary) workaround since date isn't used anyways.
+        # Date format seems to be localized... @TODO find a way to universally parse date string
+
+        # Fourth line contains number of files
+        num_files = int(header_value(lines[3]))
+
+        # Fifth line contains number of chunks
+        num_chunks = int(header_value(lines[4]))
+
+        # Sixth line contains size on disk
+        size_disk = int(header_value(lines[5]))
+
+        # Seventh line contains size compressed
+        size_compressed = int(header_value(lines[6]))
+    except (IndexError, ValueError) as e:
+        raise ValueError(f"Invalid manifest header in '{file}'") from e
+
+    # Eighth line is empty
+    # Ninth line is empty
+    # Tenth line contains headers
+    # Eleventh line until EOF contains one file per line: size, chunks, hash, flags, name
+    intern = sys.intern
+    fromhex = bytes.fromhex
+
+    try:
+        files = [(intern(fields[4]), fromhex(fields[2]), int(fields[0])) for fields in (line.split(None, 4) for line in lines[10:] if line)]
+    except (IndexError, ValueError) as e:
+        raise ValueError(f"Invalid file list in manifest '{file}'") from e
+
+    return Manifest(depot, id, date, num_files, num_chunks, size_disk, size_compressed, files)
+
+
+def to_bytes(manifest: Manifest) -> bytes:
+    """Serialize a manifest to a compact binary representation.
+
+    Args:
+        manifest (Manifest): The manifest
+
+    Returns:
+        bytes: The serialized manifest
+    """
+    date = str(manifest.date).encode()
+    names = "\0".join(name for (name, _, _) in manifest.files).encode()
+    digests = b"".join(digest for (_, digest, _) in manifest.files)
+    sizes = array("Q", [size for (_, _, size) in manifest.files])
+
+    if sys.byteorder != "little":
+        sizes.byteswap()
+
+    header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, manifest.depot, manifest.id, manifest.num_files, manifest.num_chunks,
+                                manifest.size_disk, manifest.size_compressed, len(date))
+
+    return b"".join([header, date, struct.pack("<II", len(manifest.files), len(names)), names, digests, sizes.tobytes()])
+
+
+def from_bytes(data: bytes) -> Manifest:
+    """Deserialize a manifest created by to_bytes.
+
+    Args:
+        data (bytes): The serialized manifest
+
+    Raises:
+        ValueError: If the data is not a valid serialized manifest
+
+    Returns:
+        Manifest: The manifest
+    """
+    try:
+        magic, version, depot, id, num_files, num_chunks, size_disk, size_compressed, date_length = BINARY_HEADER.unpack_from(data)
+
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            raise ValueError("Unsupported binary manifest format")
+
+        offset = BINARY_HEADER.size
+        date = data[offset:offset + date_length].decode()
+        offset += date_length
+
+        count, names_length = struct.unpack_from("<II", data, offset)
+        offset += 8
+
+        names = data[offset:offset + names_length].decode().split("\0") if count > 0 else []
+        offset += names_length
+
+        digests = data[offset:offset + count * 20]
+        offset += count * 20
+
+        sizes = array("Q")
+        sizes.frombytes(data[offset:offset + count * 8])
+        if sys.byteorder != "little":
+            sizes.byteswap()
+    except struct.error as e:
+        raise ValueError("Truncated binary manifest") from e
+
+    if len(names) != count or len(digests) != count * 20 or len(sizes) != count:
+        raise ValueError("Truncated binary manifest")
+
+    files = list(zip(map(sys.intern, names), [digests[i:i + 20] for i in range(0, len(digests), 20)], sizes.tolist()))
+
+    return Manifest(depot, id, date, num_files, num_chunks, size_disk, size_compressed, files)
+
+
+@dataclass
+class ManifestDiff():
+    # name -> [size, hash] in the newer version
+    added: dict[str, list]
+    # name -> [size, hash] in the older version
+    removed: dict[str, list]
+    # name -> [[size, hash] in the older version, [size, hash] in the newer version]
+    modified: dict[str, list]
+
+    @property
+    def added_bytes(self) -> int:
+        return sum(size for (size, _) in self.added.values())
+
+    @property
+    def removed_bytes(self) -> int:
+        return sum(size for (size, _) in self.removed.values())
+
+    @property
+    def modified_bytes(self) -> int:
+        return sum(size for (_, (size, _)) in self.modified.values())
+
+    def reversed(self) -> "ManifestDiff":
+        """Get the diff from the newer to the older version.
+
+        Returns:
+            ManifestDiff: The reversed diff
+        """
+        return ManifestDiff(dict(self.removed), dict(self.added), {name: [new_state, old_state] for name, (old_state, new_state) in self.modified.items()})
+
+    def to_dict(self) -> dict:
+        return {"added": self.added, "removed": self.removed, "modified": self.modified}
+
+    @staticmethod
+    def from_dict(data: dict) -> "ManifestDiff":
+        return ManifestDiff(data["added"], data["removed"], data["modified"])
+
+
+def diff_manifests(old: Manifest, new: Manifest) -> ManifestDiff:
+    """Compare two manifests of the same depot using a merge join over their name sorted columns.
+
+    Args:
+        old (Manifest): The manifest of the older version
+        new (Manifest): The manifest of the newer version
+
+    Returns:
+        ManifestDiff: Added, removed and modified files
+    """
+    old_names, old_digests, old_sizes = _columns(old)
+    new_names, new_digests, new_sizes = _columns(new)
+
+    added = {}
+    removed = {}
+    modified = {}
+
+    def state(digests: bytes, sizes: list[int], i: int) -> list:
+        return [sizes[i], digests[i * 20:i * 20 + 20].hex()]
+
+    # Same set of files, only compare the digest columns
+    if old_names == new_names:
+        for i in _changed_indices(old_digests, new_digests, 0, len(old_names)):
+            modified[old_names[i]] = [state(old_digests, old_sizes, i), state(new_digests, new_sizes, i)]
+
+        return ManifestDiff(added, removed, modified)
+
+    i = 0
+    j = 0
+
+    while i < len(old_names) and j < len(new_names):
+        old_name = old_names[i]
+        new_name = new_names[j]
+
+        if old_name == new_name:
+            if old_digests[i * 20:i * 20 + 20] != new_digests[j * 20:j * 20 + 20]:
+                modified[old_name] = [state(old_digests, old_sizes, i), state(new_digests, new_sizes, j)]
+            i += 1
+            j += 1
+        elif old_name < new_name:
+            removed[old_name] = state(old_digests, old_sizes, i)
+            i += 1
+        else:
+            added[new_name] = state(new_digests, new_sizes, j)
+            j += 1
+
+    for i in range(i, len(old_names)):
+        removed[old_names[i]] = state(old_digests, old_sizes, i)
+
+    for j in range(j, len(new_names)):
+        added[new_names[j]] = state(new_digests, new_sizes, j)
+
+    return ManifestDiff(added, removed, modified)
+
+
+def _columns(manifest: Manifest) -> tuple[list[str], bytes, list[int]]:
+    """Split the files of a manifest into name sorted columns.
+
+    Args:
+        manifest (Manifest): The manifest
+
+    Returns:
+        tuple[list[str], bytes, list[int]]: The names, the concatenated digests and the sizes
+    """
+    # Manifests are usually sorted already which makes this linear
+    files = sorted(manifest.files, key=itemgetter(0))
+
+    return list(map(itemgetter(0), files)), b"".join(map(itemgetter(1), files)), list(map(itemgetter(2), files))
+
+
+def _changed_indices(old_digests: bytes, new_digests: bytes, start: int, end: int) -> list[int]:
+    """Find all indices in [start, end) whose digests differ by recursively comparing whole blocks.
+
+    Args:
+        old_digests (bytes): The concatenated digests of the older version
+        new_digests (bytes): The concatenated digests of the newer version
+        start (int): The first index
+        end (int): The index after the last one
+
+    Returns:
+        list[int]: The indices of all differing digests
+    """
+    if old_digests[start * 20:end * 20] == new_digests[start * 20:end * 20]:
+        return []
+
+    if end - start <= 64:
+        return [i for i in range(start, end) if old_digests[i * 20:i * 20 + 20] != new_digests[i * 20:i * 20 + 20]]
+
+    middle = (start + end) // 2
+
+    return _changed_indices(old_digests, new_digests, start, middle) + _changed_indices(old_digests, new_digests, middle, end)
+
+
+def combine_diffs(diffs: list[ManifestDiff]) -> ManifestDiff:
+    """Combine a chain of consecutive diffs of the same depot into a single diff between the oldest and newest version.
+
+    Args:
+        diffs (list[ManifestDiff]): The diffs, ordered from oldest to newest
+
+    Returns:
+        ManifestDiff: The combined diff
+    """
+    # State of every touched file in the oldest and the newest version, None if it doesn't exist
+    first = {}
+    last = {}
+
+    for diff in diffs:
+        for name, state in diff.added.items():
+            first.setdefault(name, None)
+            last[name] = state
+
+        for name, state in diff.removed.items():
+            first.setdefault(name, state)
+            last[name] = None
+
+        for name, (old_state, new_state) in diff.modified.items():
+            first.setdefault(name, old_state)
+            last[name] = new_state
+
+    added = {name: last[name] for name in first if first[name] is None and last[name] is not None}
+    removed = {name: first[name] for name in first if first[name] is not None and last[name] is None}
+    modified = {name: [first[name], last[name]] for name in first
+                if first[name] is not None and last[name] is not None and first[name] != last[name]}
+
+    return ManifestDiff(added, removed, modified)
@@ -0,0 +1,196 @@
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+import threading
+
+import manifest
+from manifest import Manifest, ManifestDiff
+
+
+class ManifestCache:
+    """Persistent on disk cache for parsed manifests and the diffs computed between them.
+
+    A manifest never changes for a given (depot id, manifest id) so entries never have to be invalidated.
+    Every entry stores a checksum of its content and is discarded if it doesn't match anymore.
+    The least recently used entries are evicted once the cache exceeds its size limit.
+    """
+    # Increase whenever the layout of cached data changes, older entries will then be ignored and evicted eventually
+    FORMAT_VERSION = 5
+    SUFFIX = ".cache"
+
+    def __init__(self, cache_dir: pathlib.Path, max_size: int = 256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def get_manifest(self, depot_id: int, manifest_id: int) -> Manifest | None:
+        """Retrieve a parsed manifest from the cache.
+
+        Args:
+            depot_id (int): The depot of the manifest
+            manifest_id (int): The manifest id
+
+        Returns:
+            Manifest | None: The cached manifest or None if it is not cached
+        """
+        data = self._read(self._manifest_key(depot_id, manifest_id))
+
+        if data is None:
+            return None
+
+        try:
+            return manifest.from_bytes(data)
+        except ValueError:
+            return None
+
+    def put_manifest(self, parsed: Manifest) -> None:
+        """Store a parsed manifest in the cache.
+
+        Args:
+            parsed (Manifest): The manifest
+        """
+        self._write(self._manifest_key(parsed.depot, parsed.id), manifest.to_bytes(parsed))
+
+    def get_diff(self, depot_id: int, current_manifest_id: int, target_manifest_id: int) -> ManifestDiff | None:
+        """Retrieve the diff from the target to the current manifest of a depot.
+
+        Args:
+            depot_id (int): The depot
+            current_manifest_id (int): The current manifest id
+            target_manifest_id (int): The target manifest id
+
+        Returns:
+            ManifestDiff | None: The changes from the target to the current version or None if they are not cached
+        """
+        data = self._read(self._diff_key(depot_id, current_manifest_id, target_manifest_id))
+
+        if data is None:
+            return None
+
+        return ManifestDiff.from_dict(json.loads(data))
+
+    def put_diff(self, depot_id: int, current_manifest_id: int, target_manifest_id: int, diff: ManifestDiff) -> None:
+        """Store the diff from the target to the current manifest of a depot.
+
+        Args:
+            depot_id (int): The depot
+            current_manifest_id (int): The current manifest id
+            target_manifest_id (int): The target manifest id
+            diff (ManifestDiff): The changes from the target to the current version
+        """
+        self._write(self._diff_key(depot_id, current_manifest_id, target_manifest_id), json.dumps(diff.to_dict(), separators=(",", ":")).encode())
+
+    def cached_manifests(self, depot_id: int) -> set[int]:
+        """Get the ids of all cached manifests of a depot without reading them.
+
+        Args:
+            depot_id (int): The depot
+
+        Returns:
+            set[int]: The cached manifest ids
+        """
+        return {int(key[0]) for key in self._list_keys(f"manifest_v{self.FORMAT_VERSION}_{depot_id}_")}
+
+    def cached_diffs(self, depot_id: int) -> set[tuple[int, int]]:
+        """Get all cached diffs of a depot without reading them.
+
+        Args:
+            depot_id (int): The depot
+
+        Returns:
+            set[tuple[int, int]]: (current manifest id, target manifest id) of every cached diff
+        """
+        return {(int(key[0]), int(key[1])) for key in self._list_keys(f"diff_v{self.FORMAT_VERSION}_{depot_id}_")}
+
+    def _list_keys(self, prefix: str) -> list[list[str]]:
+        """List the remaining parts of all keys that start with the given prefix.
+
+        Args:
+            prefix (str): The prefix of the keys
+
+        Returns:
+            list[list[str]]: The remainder of every matching key split by underscores
+        """
+        result = []
+
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.startswith(prefix) and entry.name.endswith(self.SUFFIX):
+                result.append(entry.name[len(prefix):-len(self.SUFFIX)].split("_"))
+
+        return result
+
+    def _manifest_key(self, depot_id: int, manifest_id: int) -> str:
+        return f"manifest_v{self.FORMAT_VERSION}_{depot_id}_{manifest_id}"
+
+    def _diff_key(self, depot_id: int, current_manifest_id: int, target_manifest_id: int) -> str:
+        return f"diff_v{self.FORMAT_VERSION}_{depot_id}_{current_manifest_id}_{target_manifest_id}"
+
+    def _read(self, key: str) -> bytes | None:
+        """Read an entry and verify its integrity. Corrupted entries are removed.
+
+        Args:
+            key (str): The key of the entry
+
+        Returns:
+            bytes | None: The stored data or None if it doesn't exist or is corrupted
+        """
+        path = self.cache_dir / (key + self.SUFFIX)
+
+        with self.lock:
+            try:
+                content = path.read_bytes()
+            except OSError:
+                return None
+
+            checksum, _, payload = content.partition(b"\n")
+
+            if hashlib.sha256(payload).hexdigest().encode() != checksum:
+                print(f"Discarding corrupted cache entry {key}")
+                path.unlink(missing_ok=True)
+                return None
+
+            # Mark entry as recently used
+            os.utime(path)
+
+        return payload
+
+    def _write(self, key: str, payload: bytes) -> None:
+        """Atomically write an entry and evict old entries if necessary.
+
+        Args:
+            key (str): The key of the entry
+            payload (bytes): The data to store
+        """
+        content = hashlib.sha256(payload).hexdigest().encode() + b"\n" + payload
+
+        with self.lock:
+            # Write to temp file first so a crash never leaves a partial entry behind
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp, self.cache_dir / (key + self.SUFFIX))
+
+            self._evict()
+
+    def _evict(self) -> None:
+        """Remove least recently used entries until the cache fits into its size limit.
+        """
+        entries = []
+        total_size = 0
+
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith(self.SUFFIX):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size += stat.st_size
+
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+
+            os.unlink(path)
+            total_size -= size
@@ -0,0 +1,129 @@
+import os
+import pathlib
+import tempfile
+import threading
+
+import utils
+
+
+class ObjectStore:
+    """Local store of file contents keyed by their SHA-1 hash as listed in the manifests.
+
+    Objects are never modified in place, they are copied in and out so files in the game directory never share data with the store.
+    Files that are never modified afterwards, like backups, may be linked into the store instead.
+    The least recently used objects are evicted once the store exceeds its size limit.
+    """
+    def __init__(self, store_dir: pathlib.Path, max_size: int = 8 * 1024 * 1024 * 1024):
+        self.store_dir = store_dir
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+
+    def contains(self, sha: str) -> bool:
+        """Check if the content with the given hash is stored.
+
+        Args:
+            sha (str): The SHA-1 hash of the content
+
+        Returns:
+            bool: True if the content is stored
+        """
+        return self._path(sha).exists()
+
+    def add(self, file: pathlib.Path, sha: str | None = None, link: bool = False) -> str:
+        """Add a file to the store.
+
+        Args:
+            file (pathlib.Path): The file to add
+            sha (str, optional): The known hash of the file. Will be calculated if omitted. Defaults to None.
+            link (bool, optional): Hardlink the file instead of copying it, it must never be modified in place afterwards. Defaults to False.
+
+        Returns:
+            str: The hash of the file
+        """
+        if sha is None:
+            sha = utils.sha1_file(file)
+
+        target = self._path(sha)
+
+        if target.exists():
+            os.utime(target)
+            return sha
+
+        target.parent.mkdir(exist_ok=True)
+
+        if link:
+            try:
+                os.link(file, target)
+                return sha
+            except FileExistsError:
+                return sha
+            except OSError:
+                # Different drive or not supported by the file system
+                pass
+
+        # Copy to a temp file first so a crash never leaves a partial object behind
+        fd, tmp = tempfile.mkstemp(dir=target.parent, suffix=".tmp")
+        os.close(fd)
+        utils.clone_file(file, pathlib.Path(tmp))
+        os.replace(tmp, target)
+
+        return sha
+
+    def extract(self, sha: str, target: pathlib.Path) -> bool:
+        """Copy the content with the given hash to the target file.
+
+        Args:
+            sha (str): The SHA-1 hash of the content
+            target (pathlib.Path): The file to create
+
+        Returns:
+            bool: True if the content was stored and has been extracted, False if it is missing or corrupted
+        """
+        path = self._path(sha)
+
+        if not path.exists():
+            return False
+
+        target.parent.mkdir(parents=True, exist_ok=True)
+
+        # Objects are checked while copying, a corrupted one is dropped so the file gets downloaded instead
+        try:
+            utils.copy_file_with_hash(path, target, sha)
+        except ValueError:
+            path.unlink(missing_ok=True)
+            return False
+
+        # Mark object as recently used
+        os.utime(path)
+
+        return True
+
+    def evict(self) -> None:
+        """Remove least recently used objects until the store fits into its size limit.
+        """
+        with self.lock:
+            entries = []
+            total_size = 0
+
+            for directory in os.scandir(self.store_dir):
+                if not directory.is_dir():
+                    continue
+
+                for entry in os.scandir(directory.path):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total_size += stat.st_size
+
+            for _, size, path in sorted(entries):
+                if total_size <= self.max_size:
+                    break
+
+                os.unlink(path)
+                total_size -= size
+
+    def _path(self, sha: str) -> pathlib.Path:
+        sha = sha.lower()
+
+        return self.store_dir / sha[:2] / sha
@@ -0,0 +1,179 @@
+import json
+from dataclasses import dataclass, field
+
+
+@dataclass
+class HistoryEntry():
+    version: int
+    date: int
+    # Depot id -> manifest id of all depots, only set for snapshots
+    snapshot: dict[int, int] | None = None
+    # Depot id -> manifest id of depots that changed or were added since the previous entry
+    changed: dict[int, int] = field(default_factory=dict)
+    # Ids of depots that were removed since the previous entry
+    removed: list[int] = field(default_factory=list)
+
+
+class PatchHistory:
+    """Compact history of all patches, one JSON line per version in release order.
+
+    An entry only stores the depots that changed since the previous entry, every few entries a full snapshot is stored instead.
+    New versions are appended without rewriting existing lines. The depots of a version are rebuilt on first access
+    from the closest snapshot before it and remembered afterwards.
+    """
+    SNAPSHOT_INTERVAL = 16
+
+    def __init__(self, entries: list[HistoryEntry]):
+        self.entries = entries
+        # Entry index -> rebuilt depots
+        self.states: dict[int, dict[int, int]] = {}
+
+    @staticmethod
+    def parse(content: bytes | str) -> "PatchHistory":
+        """Parse a history file.
+
+        Args:
+            content (bytes | str): The content of the file
+
+        Raises:
+            ValueError: If a line is not a valid entry
+
+        Returns:
+            PatchHistory: The history
+        """
+        if isinstance(content, bytes):
+            content = content.decode()
+
+        entries = []
+
+        for line in content.splitlines():
+            if line.strip() == "":
+                continue
+
+            data = json.loads(line)
+
+            try:
+                entries.append(HistoryEntry(
+                    data["version"],
+                    data["date"],
+                    {int(k): v for k, v in data["snapshot"].items()} if "snapshot" in data else None,
+                    {int(k): v for k, v in data.get("changed", {}).items()},
+                    data.get("removed", [])
+                ))
+            except (KeyError, TypeError, AttributeError):
+                raise ValueError(f"Invalid history entry '{line}'")
+
+        return PatchHistory(entries)
+
+    @staticmethod
+    def from_patches(patches: list[dict]) -> "PatchHistory":
+        """Build a history from a list of full patches as stored in patches.json.
+
+        Args:
+            patches (list[dict]): The patches in release order
+
+        Returns:
+            PatchHistory: The history
+        """
+        history = PatchHistory([])
+
+        for patch in patches:
+            history.append(patch["version"], patch["date"], {d["depot_id"]: d["manifest_id"] for d in patch["depots"]})
+
+        return history
+
+    def append(self, version: int, date: int, depots: dict[int, int]) -> HistoryEntry:
+        """Append a new version.
+
+        Args:
+            version (int): The version
+            date (int): The release date as a unix timestamp
+            depots (dict[int, int]): Depot id -> manifest id of all depots
+
+        Returns:
+            HistoryEntry: The new entry
+        """
+        since_snapshot = next((i for i, entry in enumerate(reversed(self.entries)) if entry.snapshot is not None), len(self.entries))
+
+        if len(self.entries) == 0 or since_snapshot + 1 >= self.SNAPSHOT_INTERVAL:
+            entry = HistoryEntry(version, date, dict(depots))
+        else:
+            previous = self.depots(len(self.entries) - 1)
+            entry = HistoryEntry(version, date, None,
+                                 {depot_id: manifest_id for depot_id, manifest_id in depots.items() if previous.get(depot_id) != manifest_id},
+                                 sorted(previous.keys() - depots.keys()))
+
+        self.entries.append(entry)
+        self.states[len(self.entries) - 1] = dict(depots)
+
+        return entry
+
+    def depots(self, index: int) -> dict[int, int]:
+        """Get the depots of an entry, rebuilding them if necessary.
+
+        Args:
+            index (int): The index of the entry
+
+        Returns:
+            dict[int, int]: Depot id -> manifest id
+        """
+        if index in self.states:
+            return self.states[index]
+
+        # Walk back to the closest entry whose depots are known
+        start = index
+        while start >= 0 and start not in self.states and self.entries[start].snapshot is None:
+            start -= 1
+
+        if start < 0:
+            state = {}
+        elif start in self.states:
+            state = dict(self.states[start])
+        else:
+            state = dict(self.entries[start].snapshot)
+            self.states[start] = dict(state)
+
+        for i in range(start + 1, index + 1):
+            entry = self.entries[i]
+            state.update(entry.changed)
+
+            for depot_id in entry.removed:
+                state.pop(depot_id, None)
+
+            self.states[i] = dict(state)
+
+        return self.states[index]
+
+    def patches(self) -> list[dict]:
+        """Get all versions in the format of patches.json.
+
+        Returns:
+            list[dict]: The patches in release order
+        """
+        return [{
+            "version": entry.version,
+            "date": entry.date,
+            "depots": [{"depot_id": depot_id, "manifest_id": manifest_id} for depot_id, manifest_id in self.depots(i).items()]
+        } for i, entry in enumerate(self.entries)]
+
+    @staticmethod
+    def encode(entry: HistoryEntry) -> str:
+        """Encode an entry as a single line.
+
+        Args:
+            entry (HistoryEntry): The entry
+
+        Returns:
+            str: The line without line break
+        """
+        data = {"version": entry.version, "date": entry.date}
+
+        if entry.snapshot is not None:
+            data["snapshot"] = entry.snapshot
+        else:
+            if len(entry.changed) > 0:
+                data["changed"] = entry.changed
+            if len(entry.removed) > 0:
+                data["removed"] = entry.removed
+
+        return json.dumps(data, separators=(",", ":"))
@@ -0,0 +1,103 @@
+import bisect
+from collections.abc import Iterator
+
+from patch_history import PatchHistory
+
+
+class PatchIndex:
+    """Indexed view of the list of documented patches.
+
+    Patches are looked up by version in constant time, ranges of versions with a binary search.
+    Depots of two patches are joined by their id, so the order of the depots in the list doesn't matter.
+    The depots of a version are only rebuilt from the history once they are needed.
+    Manifest ids are interned because most depots keep their manifest over many patches.
+    """
+    def __init__(self, history: PatchHistory):
+        self.history = history
+        # Manifest id -> the single shared instance of it
+        self.manifest_ids: dict[int, int] = {}
+        # Version -> index of its history entry
+        self.entry_indices = {entry.version: i for i, entry in enumerate(history.entries)}
+        # Version -> depot id -> manifest id, filled on first access
+        self.depots_by_version: dict[int, dict[int, int]] = {}
+
+        # Oldest first
+        self.patches = sorted(({"version": entry.version, "date": entry.date} for entry in history.entries), key=lambda p: p["version"])
+        self.versions = [p["version"] for p in self.patches]
+        # Version -> patch
+        self.by_version = {p["version"]: p for p in self.patches}
+
+    def __len__(self) -> int:
+        return len(self.patches)
+
+    def __iter__(self) -> Iterator[dict]:
+        return iter(self.patches)
+
+    def __contains__(self, version: int) -> bool:
+        return version in self.by_version
+
+    def get(self, version: int) -> dict | None:
+        """Get the patch of a version.
+
+        Args:
+            version (int): The version
+
+        Returns:
+            dict | None: The patch or None if the version is unknown
+        """
+        return self.by_version.get(version)
+
+    def depots(self, version: int) -> dict[int, int]:
+        """Get the manifests of all depots of a version.
+
+        Args:
+            version (int): The version
+
+        Returns:
+            dict[int, int]: Depot id -> manifest id, empty if the version is unknown
+        """
+        depots = self.depots_by_version.get(version)
+
+        if depots is None:
+            if version not in self.entry_indices:
+                return {}
+
+            depots = {depot_id: self.manifest_ids.setdefault(manifest_id, manifest_id)
+                      for depot_id, manifest_id in self.history.depots(self.entry_indices[version]).items()}
+            self.depots_by_version[version] = depots
+
+        return depots
+
+    def between(self, first_version: int, last_version: int) -> list[dict]:
+        """Get all patches between two versions, both included.
+
+        Args:
+            first_version (int): The oldest version
+            last_version (int): The newest version
+
+        Returns:
+            list[dict]: The patches, oldest first
+        """
+        start = bisect.bisect_left(self.versions, first_version)
+        end = bisect.bisect_right(self.versions, last_version)
+
+        return self.patches[start:end]
+
+    def join(self, current_version: int, target_version: int) -> tuple[list[tuple[int, int, int]], list[int]]:
+        """Pair the depots of two versions by their id.
+
+        Args:
+            current_version (int): The current version
+            target_version (int): The target version
+
+        Returns:
+            tuple: A list of (depot id, current manifest id, target manifest id) of depots in both versions
+                and a list of the ids of depots that only exist in one of them
+        """
+        current = self.depots(current_version)
+        target = self.depots(target_version)
+
+        pairs = [(depot_id, manifest_id, target[depot_id]) for depot_id, manifest_id in current.items() if depot_id in target]
+        unpaired = sorted(current.keys() ^ target.keys())
+
+        return pairs, unpaired
@@ -0,0 +1,80 @@
+import json
+import os
+import pathlib
+import tempfile
+from dataclasses import asdict, dataclass, field
+
+
+@dataclass
+class JournalRecord():
+    # "backup" while installed files are moved into the backup, "apply" while patched files are moved into place
+    state: str
+    game_dir: str
+    download_dir: str
+    backup_dir: str
+    # Relative names of all patched files
+    files: list[str] = field(default_factory=list)
+    # Relative names of all files that are removed by the patch
+    removed: list[str] = field(default_factory=list)
+    # The installed version before the patch and the version the patch installs
+    version: int = 0
+    target_version: int = 0
+    # Hashes of all backed up files, taken before they are moved into the backup
+    hashes: dict[str, str] = field(default_factory=dict)
+    # Relative names of the files the patch created, determined before the restore point is created
+    created: list[str] | None = None
+    # Id of the restore point that is created from the backup, empty if the backup is dropped once the patch has been applied
+    restore_point: str = ""
+
+
+class PatchJournal:
+    """Write-ahead journal of the file operations of a patch.
+
+    The record is written before the game directory is touched so an interrupted patch can be undone or completed on the next start.
+    It is removed once the patch has been applied and its restore point has been created.
+    """
+    FORMAT_VERSION = 2
+
+    def __init__(self, journal_file: pathlib.Path):
+        self.journal_file = journal_file
+
+    def load(self) -> JournalRecord | None:
+        """Load the current record.
+
+        Returns:
+            JournalRecord | None: The record or None if there is none or it is unreadable
+        """
+        try:
+            with open(self.journal_file) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if data.pop("format", None) != self.FORMAT_VERSION:
+            return None
+
+        try:
+            return JournalRecord(**data)
+        except TypeError:
+            return None
+
+    def write(self, record: JournalRecord) -> None:
+        """Durably replace the current record. Returns once the record is on disk.
+
+        Args:
+            record (JournalRecord): The record
+        """
+        self.journal_file.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write to temp file first so a crash never leaves a partial record behind
+        fd, tmp = tempfile.mkstemp(dir=self.journal_file.parent, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"format": self.FORMAT_VERSION, **asdict(record)}, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.journal_file)
+
+    def clear(self) -> None:
+        """Remove the current record.
+        """
+        self.journal_file.unlink(missing_ok=True)
@@ -0,0 +1,383 @@
+import heapq
+import os
+import pathlib
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from manifest_cache import ManifestCache
+from object_store import ObjectStore
+from patch_index import PatchIndex
+from web_helper import WebHelper
+import manifest
+import utils
+
+
+@dataclass
+class PatchPlan():
+    installed_version: int
+    target_version: int
+    # (depot id, installed manifest id, target manifest id) of every depot that changes
+    depots: list[tuple[int, int, int]]
+    # Depot id -> changes from the target to the installed version, None as long as they are unknown
+    diffs: dict[int, manifest.ManifestDiff | None]
+    # Ids of depots that only exist in one of the two versions
+    discarded: list[int] = field(default_factory=list)
+    # Bytes that have to be downloaded, contents available in the object store are excluded
+    download_size: int = 0
+    # Bytes of all files placed in the download directory
+    staging_size: int = 0
+    # Bytes of all installed files that are replaced or removed and therefore backed up
+    backup_size: int = 0
+
+    @property
+    def complete(self) -> bool:
+        """Whether the changes of all depots are known and the estimates are exact.
+        """
+        return all(diff is not None for diff in self.diffs.values())
+
+    @property
+    def growth(self) -> int:
+        """The change in size of the game directory once the patch is applied.
+        """
+        return self.staging_size - self.backup_size
+
+
+class PatchPlanner:
+    """Determines the changes between two versions from the cheapest available source and estimates the resources needed to apply them.
+
+    Changes of a depot are taken from cached diffs and manifests, combined over intermediate versions if necessary, or from the changes
+    published for every version. Depots whose changes can't be determined that way require their manifests to be downloaded.
+    The source of the changes doesn't affect what is downloaded, contents of any version seen before are taken from the object store.
+    """
+    # Costs of the sources the changes of a depot can be determined from locally, comparing manifests is slower than reading a diff
+    DIFF_COST = 1
+    MANIFEST_COST = 4
+
+    def __init__(self, patch_index: PatchIndex, manifest_cache: ManifestCache, object_store: ObjectStore, webhook: WebHelper, workers: int = 4):
+        self.patch_index = patch_index
+        self.manifest_cache = manifest_cache
+        self.object_store = object_store
+        self.webhook = webhook
+        # Maximum number of published diffs that are queried at the same time
+        self.workers = workers
+
+    def plan(self, installed_version: int, target_version: int, remote: bool = False) -> PatchPlan:
+        """Determine the changes from the target to the installed version and estimate the resources needed.
+
+        Args:
+            installed_version (int): The currently installed version
+            target_version (int): The target version
+            remote (bool, optional): Query the published changes for depots that can't be determined locally. Defaults to False.
+
+        Raises:
+            Exception: If one of the versions is unknown
+
+        Returns:
+            PatchPlan: The plan, changes of depots that could not be determined are None
+        """
+        patch_index = self.patch_index
+
+        for version in (installed_version, target_version):
+            if version not in patch_index:
+                raise Exception(f"Version {version} is unknown")
+
+        # Depot ids change sometimes (VCRedist for example)
+        # (Temporary?) solution just skip depots that don't exist in both versions since old depots are no longer available and hope it still works
+        pairs, discarded = patch_index.join(installed_version, target_version)
+
+        # Only need to check for changes if manifest changed
+        plan = PatchPlan(installed_version, target_version, [pair for pair in pairs if pair[1] != pair[2]], {}, discarded)
+
+        for depot_id, current_manifest_id, target_manifest_id in plan.depots:
+            plan.diffs[depot_id] = self._local_diff(depot_id, current_manifest_id, target_manifest_id)
+
+        # Try to use the changes published for every version in between before any manifests have to be downloaded
+        missing = [depot for depot in plan.depots if plan.diffs[depot[0]] is None]
+
+        if remote and len(missing) > 0:
+            remote_diffs = self._remote_diffs(installed_version, target_version, missing)
+
+            for depot_id, current_manifest_id, target_manifest_id in missing:
+                if depot_id in remote_diffs:
+                    self.manifest_cache.put_diff(depot_id, current_manifest_id, target_manifest_id, remote_diffs[depot_id])
+                    plan.diffs[depot_id] = remote_diffs[depot_id]
+
+        self.estimate(plan)
+
+        return plan
+
+    def plan_older(self, installed_version: int, remote: bool = False) -> dict[int, PatchPlan]:
+        """Plan patches to every version older than the installed one.
+        Published changes are queried once per version and combined step by step while walking back from the installed version.
+
+        Args:
+            installed_version (int): The currently installed version
+            remote (bool, optional): Query the published changes for depots that can't be determined locally. Defaults to False.
+
+        Returns:
+            dict[int, PatchPlan]: The plan for every older version keyed by version, empty if the installed version is unknown
+        """
+        patch_index = self.patch_index
+
+        if installed_version not in patch_index or len(patch_index) == 0:
+            return {}
+
+        # All versions up to the installed version, oldest first
+        chain = patch_index.between(patch_index.versions[0], installed_version)
+        steps = self._query_steps(chain) if remote else [(old_patch, new_patch, None) for old_patch, new_patch in zip(chain, chain[1:])]
+
+        # Depot id -> published changes from the version planned last to the installed version, None once a step is not published
+        combined: dict[int, manifest.ManifestDiff | None] = {depot_id: manifest.ManifestDiff({}, {}, {}) for depot_id in patch_index.depots(installed_version)}
+        plans = {}
+
+        for old_patch, new_patch, diff in reversed(steps):
+            for depot_id, depot_diff in combined.items():
+                if depot_diff is None:
+                    continue
+
+                step = self._published_step(diff, depot_id, old_patch["version"], new_patch["version"])
+
+                if step is None:
+                    combined[depot_id] = None
+                elif len(step.added) + len(step.removed) + len(step.modified) > 0:
+                    combined[depot_id] = manifest.combine_diffs([step, depot_diff])
+
+            plan = self.plan(installed_version, old_patch["version"])
+
+            for depot_id, _, _ in plan.depots:
+                if plan.diffs[depot_id] is None:
+                    plan.diffs[depot_id] = combined.get(depot_id)
+
+            self.estimate(plan)
+            plans[old_patch["version"]] = plan
+
+        return plans
+
+    def estimate(self, plan: PatchPlan) -> None:
+        """Update the size estimates of a plan from its known changes.
+
+        Args:
+            plan (PatchPlan): The plan
+        """
+        plan.download_size = 0
+        plan.staging_size = 0
+        plan.backup_size = 0
+
+        for diff in plan.diffs.values():
+            if diff is None:
+                continue
+
+            # Removed and modified files are restored to their state in the target version
+            for size, sha in list(diff.removed.values()) + [old_state for (old_state, _) in diff.modified.values()]:
+                plan.staging_size += size
+
+                if not self.object_store.contains(sha):
+                    plan.download_size += size
+
+            # Modified and added files of the installed version are backed up
+            plan.backup_size += diff.modified_bytes + diff.added_bytes
+
+    def check_disk_space(self, plan: PatchPlan, work_dir: pathlib.Path, game_dir: pathlib.Path) -> None:
+        """Check that there is enough free disk space to apply the plan.
+        The object store is not included since it evicts contents down to its own size limit.
+
+        Args:
+            plan (PatchPlan): The plan
+            work_dir (pathlib.Path): The directory downloads and backups are placed in
+            game_dir (pathlib.Path): The game directory
+
+        Raises:
+            Exception: If a drive doesn't have enough free space
+        """
+        # Device -> (path, required bytes)
+        required: dict[int, tuple[pathlib.Path, int]] = {}
+
+        for path, size in [(work_dir, plan.staging_size + plan.backup_size), (game_dir, max(0, plan.growth))]:
+            device = os.stat(path).st_dev
+            device_path, device_size = required.get(device, (path, 0))
+            required[device] = (device_path, device_size + size)
+
+        for path, size in required.values():
+            free = shutil.disk_usage(path).free
+
+            if size > free:
+                raise Exception(f"Not enough disk space for {path.absolute()}: {utils.format_size(size)} required, {utils.format_size(free)} available")
+
+    def _local_diff(self, depot_id: int, current_manifest_id: int, target_manifest_id: int) -> manifest.ManifestDiff | None:
+        """Determine the changes of a depot from cached diffs and manifests using the cheapest route over any cached manifest.
+
+        Args:
+            depot_id (int): The depot
+            current_manifest_id (int): The installed manifest id
+            target_manifest_id (int): The target manifest id
+
+        Returns:
+            manifest.ManifestDiff | None: The changes from the target to the installed version or None if they can't be determined locally
+        """
+        # Manifest id -> list of (next manifest id, cost, kind of step)
+        edges: dict[int, list[tuple[int, int, str]]] = {}
+
+        # A cached diff (current, target) contains the changes from target to current
+        for current, target in self.manifest_cache.cached_diffs(depot_id):
+            edges.setdefault(target, []).append((current, self.DIFF_COST, "diff"))
+            edges.setdefault(current, []).append((target, self.DIFF_COST, "reversed"))
+
+        # Any two cached manifests can be compared directly
+        cached_manifests = self.manifest_cache.cached_manifests(depot_id)
+        for first in cached_manifests:
+            for second in cached_manifests:
+                if first != second:
+                    edges.setdefault(first, []).append((second, self.MANIFEST_COST, "manifests"))
+
+        # Dijkstra from the target to the installed manifest
+        costs = {target_manifest_id: 0}
+        previous: dict[int, tuple[int, str]] = {}
+        queue = [(0, target_manifest_id)]
+
+        while queue:
+            cost, node = heapq.heappop(queue)
+
+            if node == current_manifest_id:
+                break
+
+            if cost > costs[node]:
+                continue
+
+            for next_node, step_cost, kind in edges.get(node, []):
+                if cost + step_cost < costs.get(next_node, cost + step_cost + 1):
+                    costs[next_node] = cost + step_cost
+                    previous[next_node] = (node, kind)
+                    heapq.heappush(queue, (cost + step_cost, next_node))
+
+        if current_manifest_id not in previous:
+            return None
+
+        # Reconstruct the route, oldest step first
+        route = []
+        node = current_manifest_id
+        while node != target_manifest_id:
+            previous_node, kind = previous[node]
+            route.insert(0, (previous_node, node, kind))
+            node = previous_node
+
+        if route == [(target_manifest_id, current_manifest_id, "diff")]:
+            return self.manifest_cache.get_diff(depot_id, current_manifest_id, target_manifest_id)
+
+        diffs = []
+
+        for old, new, kind in route:
+            match kind:
+                case "diff":
+                    diff = self.manifest_cache.get_diff(depot_id, new, old)
+                case "reversed":
+                    diff = self.manifest_cache.get_diff(depot_id, old, new)
+                    diff = diff.reversed() if diff is not None else None
+                case _:
+                    old_manifest = self.manifest_cache.get_manifest(depot_id, old)
+                    new_manifest = self.manifest_cache.get_manifest(depot_id, new)
+                    diff = manifest.diff_manifests(old_manifest, new_manifest) if old_manifest is not None and new_manifest is not None else None
+
+            # Entry has been evicted or was corrupted in the meantime
+            if diff is None:
+                return None
+
+            diffs.append(diff)
+
+        result = diffs[0] if len(diffs) == 1 else manifest.combine_diffs(diffs)
+
+        # Remember the result so the route doesn't have to be walked again
+        self.manifest_cache.put_diff(depot_id, current_manifest_id, target_manifest_id, result)
+
+        return result
+
+    def _remote_diffs(self, installed_version: int, target_version: int, depots: list[tuple[int, int, int]]) -> dict[int, manifest.ManifestDiff]:
+        """Get the changes of the given depots by combining the published changes of all versions in between.
+
+        Args:
+            installed_version (int): The currently installed version
+            target_version (int): The target version
+            depots (list[tuple[int, int, int]]): A list of (depot id, current manifest id, target manifest id)
+
+        Returns:
+            dict: The changes from the target to the current version for every depot they could be reconstructed for
+        """
+        # All versions from the target up to the installed version, oldest first
+        steps = self._query_steps(self.patch_index.between(target_version, installed_version))
+
+        result = {}
+
+        for depot_id, current_manifest_id, target_manifest_id in depots:
+            depot_diffs = []
+
+            for old_patch, new_patch, diff in steps:
+                step = self._published_step(diff, depot_id, old_patch["version"], new_patch["version"])
+
+                # Chain is broken
+                if step is None:
+                    break
+
+                depot_diffs.append(step)
+            else:
+                result[depot_id] = manifest.combine_diffs(depot_diffs)
+
+        if len(result) > 0:
+            print(f"Using published changes for depots {', '.join(str(depot_id) for depot_id in result)}")
+
+        return result
+
+    def _query_steps(self, chain: list[dict]) -> list[tuple[dict, dict, dict | None]]:
+        """Query the published changes between every two consecutive versions of a chain.
+
+        Args:
+            chain (list[dict]): The patches, oldest first
+
+        Returns:
+            list: A list of (older patch, newer patch, published changes) where the changes are None if they are not available
+        """
+        steps = list(zip(chain, chain[1:]))
+
+        def query(step: tuple[dict, dict]) -> dict | Exception | None:
+            try:
+                return self.webhook.query_diff(step[0]["version"], step[1]["version"])
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            diffs = list(executor.map(query, steps))
+
+        errors = [diff for diff in diffs if isinstance(diff, Exception)]
+        if len(errors) > 0:
+            print(f"Could not query published changes of {len(errors)} versions: {errors[0]}")
+
+        return [(old_patch, new_patch, None if isinstance(diff, Exception) else diff) for (old_patch, new_patch), diff in zip(steps, diffs)]
+
+    def _published_step(self, diff: dict | None, depot_id: int, old_version: int, new_version: int) -> manifest.ManifestDiff | None:
+        """Get the published changes of a depot between two consecutive versions.
+
+        Args:
+            diff (dict | None): The published changes of all depots between the two versions
+            depot_id (int): The depot
+            old_version (int): The older version
+            new_version (int): The newer version
+
+        Returns:
+            manifest.ManifestDiff | None: The changes or None if the depot is missing in one of the versions or its changes are not published
+        """
+        old_manifest_id = self.patch_index.depots(old_version).get(depot_id)
+        new_manifest_id = self.patch_index.depots(new_version).get(depot_id)
+
+        # Depot missing in one of the versions
+        if old_manifest_id is None or new_manifest_id is None:
+            return None
+
+        if old_manifest_id == new_manifest_id:
+            return manifest.ManifestDiff({}, {}, {})
+
+        depot_diff = diff["depots"].get(str(depot_id)) if diff is not None else None
+
+        # Changes for this step are not published
+        if depot_diff is None or depot_diff["old_manifest"] != old_manifest_id or depot_diff["new_manifest"] != new_manifest_id:
+            return None
+
+        return manifest.ManifestDiff.from_dict(depot_diff)
@@ -0,0 +1,139 @@
+import codecs
+import io
+import locale
+import os
+import queue
+import re
+import selectors
+import subprocess
+import sys
+import threading
+from typing import BinaryIO
+
+
+class LineStream:
+    """Splits the raw output of a process into lines.
+
+    A trailing partial line is handed over as well if it matches the pattern, prompts don't end with a newline.
+    """
+    def __init__(self, stream: BinaryIO, pattern: re.Pattern, lines: queue.SimpleQueue):
+        # Kept open until the end of the output has been read
+        self.stream = stream
+        self.pattern = pattern
+        self.lines = lines
+        # Decodes like a process opened in text mode would
+        self.decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(locale.getpreferredencoding(False))(errors="replace"), translate=True)
+        self.buffer = ""
+
+    def feed(self, data: bytes) -> None:
+        *complete, self.buffer = (self.buffer + self.decoder.decode(data)).split("\n")
+
+        for line in complete:
+            self.lines.put(line + "\n")
+
+        if self.buffer != "" and self.pattern.search(self.buffer):
+            self.lines.put(self.buffer)
+            self.buffer = ""
+
+    def close(self) -> None:
+        self.buffer += self.decoder.decode(b"", final=True)
+
+        if self.buffer != "":
+            self.lines.put(self.buffer)
+            self.buffer = ""
+
+        # Marks the end of the output
+        self.lines.put(None)
+        self.stream.close()
+
+
+class ProcessOutputWatcher:
+    """Hands over the output of any number of processes as soon as it is available.
+
+    On POSIX a single thread waits on the pipes of all processes with a selector.
+    Pipes can't be selected on Windows, every process gets a thread blocking on its pipe there instead.
+    """
+    CHUNK_SIZE = 65536
+
+    def __init__(self, pattern: re.Pattern):
+        # Partial lines matching this pattern are handed over without waiting for the rest of the line
+        self.pattern = pattern
+        self.lock = threading.Lock()
+        self.selector: selectors.BaseSelector | None = None
+        # Pipe used to wake up the selector when a new process is registered
+        self.wakeup: tuple[int, int] | None = None
+
+    def watch(self, process: subprocess.Popen) -> queue.SimpleQueue:
+        """Start watching the output of a process. It must have been started with a binary stdout pipe.
+
+        Args:
+            process (subprocess.Popen): The process
+
+        Returns:
+            queue.SimpleQueue: Receives the output line by line, None once the output has ended
+        """
+        assert process.stdout is not None
+
+        lines: queue.SimpleQueue[str | None] = queue.SimpleQueue()
+        stream = LineStream(process.stdout, self.pattern, lines)
+        fd = process.stdout.fileno()
+
+        if sys.platform == "win32":
+            t = threading.Thread(target=self._read_blocking, args=(fd, stream), daemon=True)
+            t.start()
+        else:
+            selector, wakeup = self._get_selector()
+
+            os.set_blocking(fd, False)
+            selector.register(fd, selectors.EVENT_READ, stream)
+            os.write(wakeup, b"\0")
+
+        return lines
+
+    def _read_blocking(self, fd: int, stream: LineStream) -> None:
+        try:
+            while data := os.read(fd, self.CHUNK_SIZE):
+                stream.feed(data)
+        except OSError:
+            pass
+
+        stream.close()
+
+    def _get_selector(self) -> tuple[selectors.BaseSelector, int]:
+        """Get the selector and the write end of its wakeup pipe, both are created on first use.
+
+        Returns:
+            tuple: The selector and the file descriptor to wake it up
+        """
+        with self.lock:
+            if self.selector is None:
+                self.selector = selectors.DefaultSelector()
+                self.wakeup = os.pipe()
+                os.set_blocking(self.wakeup[0], False)
+                self.selector.register(self.wakeup[0], selectors.EVENT_READ, None)
+
+                t = threading.Thread(target=self._select, args=(self.selector,), daemon=True)
+                t.start()
+
+            return self.selector, self.wakeup[1]
+
+    def _select(self, selector: selectors.BaseSelector) -> None:
+        while True:
+            for key, _ in selector.select():
+                # Only wakes up the selector so new processes are picked up
+                if key.data is None:
+                    os.read(key.fd, self.CHUNK_SIZE)
+                    continue
+
+                try:
+                    data = os.read(key.fd, self.CHUNK_SIZE)
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    data = b""
+
+                if data:
+                    key.data.feed(data)
+                else:
+                    selector.unregister(key.fd)
+                    key.data.close()
@@ -0,0 +1,207 @@
+import threading
+import time
+from collections.abc import Callable
+from dataclasses import dataclass, replace
+
+
+@dataclass
+class DownloadProgress():
+    # The download, "total" for the combination of all downloads
+    name: str
+    bytes_done: int
+    bytes_total: int
+    # Bytes per second, smoothed over the last updates
+    rate: float
+    # Seconds since the download last made progress, a stalled download keeps growing this while a slow one doesn't
+    idle: float = 0.0
+
+    @property
+    def eta(self) -> float | None:
+        """Estimated seconds until the download is done or None if it is not making progress.
+        """
+        if self.rate <= 0:
+            return None
+
+        return max(0, self.bytes_total - self.bytes_done) / self.rate
+
+
+class ProgressTracker:
+    """Combines the progress of all running downloads.
+
+    Downloads report the fraction they are done, it is converted to bytes using their expected size.
+    A download is only timed once it has started, waiting for the login doesn't make it look stalled.
+    A download without progress for STALL_SECONDS is considered stalled, its rate is dropped so it doesn't keep the estimate optimistic.
+    Listeners receive the progress of the updated download together with the combined progress, possibly from several threads.
+    The current state can be polled at any time as well, which is what the GUI does.
+    """
+    # Weight of the newest measurement in the smoothed rate
+    SMOOTHING = 0.3
+    # Seconds without progress after which a started download is considered stalled, slow downloads still report every now and then
+    STALL_SECONDS = 30
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Name -> progress of every download since the last reset
+        self.downloads: dict[str, DownloadProgress] = {}
+        # Name -> time of the last progress of every started download
+        self.updated: dict[str, float] = {}
+        self.listeners: list[Callable[[DownloadProgress, DownloadProgress], None]] = []
+
+    def subscribe(self, listener: Callable[[DownloadProgress, DownloadProgress], None]) -> None:
+        """Get notified of every update.
+
+        Args:
+            listener (Callable[[DownloadProgress, DownloadProgress], None]): Called with the progress of the updated download and the combined progress
+        """
+        with self.lock:
+            self.listeners.append(listener)
+
+    def reset(self) -> None:
+        """Forget all downloads.
+        """
+        with self.lock:
+            self.downloads.clear()
+            self.updated.clear()
+
+    def add(self, name: str, bytes_total: int) -> None:
+        """Add a download that is expected to start eventually.
+
+        Args:
+            name (str): The unique name of the download
+            bytes_total (int): The expected number of bytes
+        """
+        with self.lock:
+            self.downloads[name] = DownloadProgress(name, 0, bytes_total, 0.0)
+            self.updated.pop(name, None)
+
+    def start(self, name: str) -> None:
+        """Mark a download as started, its rate and idle time are measured from now on. Calling it again has no effect.
+
+        Args:
+            name (str): The name of the download
+        """
+        with self.lock:
+            if name in self.downloads and name not in self.updated:
+                self.updated[name] = time.monotonic()
+
+    def update(self, name: str, fraction: float) -> None:
+        """Report the progress of a download.
+
+        Args:
+            name (str): The name of the download
+            fraction (float): How much of the download is done, between 0 and 1
+        """
+        with self.lock:
+            download = self.downloads.get(name)
+
+            if download is None:
+                return
+
+            now = time.monotonic()
+            bytes_done = int(download.bytes_total * min(1.0, max(0.0, fraction)))
+
+            # Progress is only reported once a file is done, it never goes back
+            if bytes_done > download.bytes_done:
+                # Without a start the time the download took is unknown, its rate is measured from the next progress on
+                if name in self.updated:
+                    elapsed = now - self.updated[name]
+
+                    if elapsed > 0:
+                        rate = (bytes_done - download.bytes_done) / elapsed
+                        download.rate = rate if download.rate == 0 else self.SMOOTHING * rate + (1 - self.SMOOTHING) * download.rate
+
+                download.bytes_done = bytes_done
+                self.updated[name] = now
+
+            download = self._current(download, now)
+            total = self._total(now)
+            listeners = list(self.listeners)
+
+        for listener in listeners:
+            listener(download, total)
+
+    def finish(self, name: str) -> None:
+        """Mark a download as done.
+
+        Args:
+            name (str): The name of the download
+        """
+        self.update(name, 1.0)
+
+    def downloads_in_progress(self) -> list[DownloadProgress]:
+        """Get the progress of every download that has started and is not done yet.
+
+        Returns:
+            list[DownloadProgress]: The progress of the downloads
+        """
+        with self.lock:
+            now = time.monotonic()
+
+            return [self._current(download, now) for download in self.downloads.values()
+                    if download.name in self.updated and download.bytes_done < download.bytes_total]
+
+    def total(self) -> DownloadProgress:
+        """Get the combined progress of all downloads.
+
+        Returns:
+            DownloadProgress: The combined progress
+        """
+        with self.lock:
+            return self._total(time.monotonic())
+
+    def _current(self, download: DownloadProgress, now: float) -> DownloadProgress:
+        """Get a copy of the progress of a download as of now.
+
+        Args:
+            download (DownloadProgress): The progress of the download
+            now (float): The current time
+
+        Returns:
+            DownloadProgress: The copy with its idle time updated and without a rate if it is stalled
+        """
+        if download.name not in self.updated or download.bytes_done >= download.bytes_total:
+            return replace(download, idle=0.0)
+
+        idle = now - self.updated[download.name]
+
+        return replace(download, rate=download.rate if idle < self.STALL_SECONDS else 0.0, idle=idle)
+
+    def _total(self, now: float) -> DownloadProgress:
+        current = [self._current(download, now) for download in self.downloads.values()]
+        bytes_done = sum(download.bytes_done for download in current)
+        bytes_total = sum(download.bytes_total for download in current)
+        # Concurrent downloads add up, finished ones don't contribute anymore
+        rate = sum(download.rate for download in current if download.bytes_done < download.bytes_total)
+        # Time since any running download made progress
+        running = [download.idle for download in current if download.name in self.updated and download.bytes_done < download.bytes_total]
+
+        return DownloadProgress("total", bytes_done, bytes_total, rate, min(running, default=0.0))
+
+
+class SequentialProgress:
+    """Combines the progress of parts that are downloaded one after another by a single process into one fraction.
+
+    The process reports every part from 0 to 1 again, a drop marks the start of the next part. Parts are weighted by their size.
+    """
+    def __init__(self, sizes: list[int], on_progress: Callable[[float], None]):
+        # Expected bytes of every part in the order they are downloaded
+        self.sizes = sizes
+        self.on_progress = on_progress
+        self.total = max(1, sum(sizes))
+        # Index of the part in progress and the bytes of all parts before it
+        self.part = 0
+        self.done = 0
+        self.last_fraction = 0.0
+
+    def update(self, fraction: float) -> None:
+        """Report the progress of the part in progress.
+
+        Args:
+            fraction (float): How much of the part is done, between 0 and 1
+        """
+        if fraction < self.last_fraction and self.part + 1 < len(self.sizes):
+            self.done += self.sizes[self.part]
+            self.part += 1
+
+        self.last_fraction = fraction
+        self.on_progress((self.done + self.sizes[self.part] * fraction) / self.total)
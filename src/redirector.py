@@ -1,4 +1,7 @@
-import utils
+import os
+import pathlib
+import queue
+import tkinter
 
 
 class IORedirector(object):
@@ -8,8 +11,101 @@ class IORedirector(object):
 
 
 class StdoutRedirector(IORedirector):
-    def write(self, text):
-        utils.log(self.text_widget, text)
+    """Thread-safe sink for everything written to stdout.
 
-    def flush(self):
+    Writes only enqueue the text, the Tk loop drains the queue at a fixed rate and inserts everything at once.
+    The widget keeps the most recent lines only, the full output is streamed to a log file that is rotated once it gets too large.
+    """
+    def __init__(self, text_widget: tkinter.Text, log_file: pathlib.Path, interval: int = 1000 // 30, max_lines: int = 5000,
+                 max_log_size: int = 5 * 1024 * 1024, log_backups: int = 2):
+        super().__init__(text_widget)
+        # Milliseconds between two updates of the widget
+        self.interval = interval
+        # Maximum number of lines kept in the widget, older lines are removed first
+        self.max_lines = max_lines
+        # Log files are rotated once they exceed this size, the previous ones are kept as log.1.txt and log.2.txt by default
+        self.log_file = log_file
+        self.max_log_size = max_log_size
+        self.log_backups = log_backups
+        self.queue: queue.SimpleQueue[str] = queue.SimpleQueue()
+        self.after_id = None
+
+        # Every start begins a new log file, the one of the previous start becomes the first backup
+        self._rotate()
+        self.after_id = self.text_widget.after(self.interval, self._drain)
+
+    def write(self, text: str) -> None:
+        self.queue.put(text)
+
+    def flush(self) -> None:
         pass
+
+    def close(self) -> None:
+        """Stop updating the widget and write everything that is still queued to the log file.
+        """
+        if self.after_id is not None:
+            self.text_widget.after_cancel(self.after_id)
+            self.after_id = None
+
+        self._write_log(self._take_queued())
+        self.file.close()
+
+    def _take_queued(self) -> str:
+        """Take all queued text.
+
+        Returns:
+            str: The text in the order it was written
+        """
+        parts = []
+
+        while True:
+            try:
+                parts.append(self.queue.get_nowait())
+            except queue.Empty:
+                return "".join(parts)
+
+    def _drain(self) -> None:
+        """Move all queued text to the widget and the log file. Runs on the Tk loop.
+        """
+        text = self._take_queued()
+
+        if text != "":
+            self._write_log(text)
+
+            self.text_widget.configure(state="normal")
+            self.text_widget.insert("end", text)
+
+            # Drop the oldest lines, the log file still contains them
+            lines = int(self.text_widget.index("end-1c").split(".")[0])
+            if lines > self.max_lines:
+                self.text_widget.delete("1.0", f"{lines - self.max_lines + 1}.0")
+
+            self.text_widget.configure(state="disabled")
+            self.text_widget.see("end")
+
+        self.after_id = self.text_widget.after(self.interval, self._drain)
+
+    def _write_log(self, text: str) -> None:
+        if text == "":
+            return
+
+        self.file.write(text)
+        self.file.flush()
+
+        if self.file.tell() > self.max_log_size:
+            self.file.close()
+            self._rotate()
+
+    def _rotate(self) -> None:
+        """Shift the existing log files by one, dropping the oldest, and open a new one.
+        """
+        for i in range(self.log_backups - 1, 0, -1):
+            backup = self.log_file.with_suffix(f".{i}{self.log_file.suffix}")
+
+            if backup.exists():
+                os.replace(backup, self.log_file.with_suffix(f".{i + 1}{self.log_file.suffix}"))
+
+        if self.log_backups > 0 and self.log_file.exists():
+            os.replace(self.log_file, self.log_file.with_suffix(f".1{self.log_file.suffix}"))
+
+        self.file = open(self.log_file, "w", encoding="utf-8")
@@ -0,0 +1,180 @@
+import json
+import os
+import pathlib
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+
+import utils
+
+
+@dataclass
+class RestorePoint():
+    id: str
+    game_dir: str
+    # The installed version before the patch, restoring the point returns to this version
+    version: int
+    # The version the patch installed
+    target_version: int
+    date: float
+    # Relative name -> hash of every file that has been replaced or removed by the patch
+    files: dict[str, str] = field(default_factory=dict)
+    # Relative names of files the patch created
+    created: list[str] = field(default_factory=list)
+    # Total size of the stored files
+    size: int = 0
+
+
+class RestorePointStore:
+    """Restore points taken before every patch, one per patch.
+
+    File contents are stored once by their hash and shared by all restore points so repeated patches only store new contents.
+    The oldest restore points are removed once the store exceeds its size limit, the newest one is always kept.
+    """
+    FORMAT_VERSION = 1
+
+    def __init__(self, root_dir: pathlib.Path, max_size: int = 8 * 1024 * 1024 * 1024):
+        self.points_dir = root_dir / "points"
+        self.objects_dir = root_dir / "objects"
+        self.max_size = max_size
+
+        self.points_dir.mkdir(parents=True, exist_ok=True)
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+
+    def list_points(self, game_dir: pathlib.Path) -> list[RestorePoint]:
+        """Get all restore points of a game directory.
+
+        Args:
+            game_dir (pathlib.Path): The game directory
+
+        Returns:
+            list[RestorePoint]: The restore points, oldest first
+        """
+        return [point for point in self._load_all() if point.game_dir == str(game_dir.absolute())]
+
+    def create(self, id: str, game_dir: pathlib.Path, version: int, target_version: int, backup_dir: pathlib.Path, hashes: dict[str, str],
+               created: list[str]) -> RestorePoint:
+        """Create a restore point from a backup directory. The backed up files are moved into the store.
+        The restore point is written before any file is moved, calling this again with the same id completes an interrupted creation.
+
+        Args:
+            id (str): The unique id of the restore point
+            game_dir (pathlib.Path): The game directory
+            version (int): The installed version before the patch
+            target_version (int): The version the patch installed
+            backup_dir (pathlib.Path): The directory containing the backed up files
+            hashes (dict[str, str]): The hashes of all backed up files keyed by their relative names
+            created (list[str]): Relative names of the files the patch created
+
+        Returns:
+            RestorePoint: The restore point
+        """
+        point = next((point for point in self._load_all() if point.id == id), None)
+
+        if point is None:
+            point = RestorePoint(id, str(game_dir.absolute()), version, target_version, time.time(), created=[name.replace("\\", "/") for name in created])
+
+            for name, sha in hashes.items():
+                source = backup_dir / utils.manifest_path(name)
+
+                if source.is_file():
+                    point.files[name.replace("\\", "/")] = sha
+                    point.size += source.stat().st_size
+
+            # Written first so the contents are referenced as soon as they are moved
+            self._save(point)
+
+        for name, sha in point.files.items():
+            source = backup_dir / utils.manifest_path(name)
+            target = self.object_path(sha)
+
+            # Moved already
+            if not source.is_file():
+                continue
+
+            # Content is already stored by another restore point
+            if target.exists():
+                source.unlink()
+            else:
+                target.parent.mkdir(exist_ok=True)
+                utils.move_file(source, target)
+
+        self.evict()
+
+        return point
+
+    def remove(self, point: RestorePoint) -> None:
+        """Remove a restore point. Its contents are removed once no other restore point references them.
+
+        Args:
+            point (RestorePoint): The restore point
+        """
+        (self.points_dir / f"{point.id}.json").unlink(missing_ok=True)
+
+        self._remove_unreferenced()
+
+    def evict(self) -> None:
+        """Remove the oldest restore points until the store fits into its size limit.
+        """
+        points = self._load_all()
+
+        while len(points) > 1 and self._referenced_size(points) > self.max_size:
+            oldest = points.pop(0)
+            print(f"Removing restore point of version {oldest.version} to stay within the disk budget")
+            (self.points_dir / f"{oldest.id}.json").unlink(missing_ok=True)
+
+        self._remove_unreferenced()
+
+    def object_path(self, sha: str) -> pathlib.Path:
+        sha = sha.lower()
+
+        return self.objects_dir / sha[:2] / sha
+
+    def _referenced_size(self, points: list[RestorePoint]) -> int:
+        total = 0
+
+        for sha in {sha for point in points for sha in point.files.values()}:
+            try:
+                total += self.object_path(sha).stat().st_size
+            except OSError:
+                pass
+
+        return total
+
+    def _remove_unreferenced(self) -> None:
+        referenced = {sha for point in self._load_all() for sha in point.files.values()}
+
+        for directory in os.scandir(self.objects_dir):
+            if not directory.is_dir():
+                continue
+
+            for entry in os.scandir(directory.path):
+                if entry.name not in referenced:
+                    os.unlink(entry.path)
+
+    def _load_all(self) -> list[RestorePoint]:
+        points = []
+
+        for entry in os.scandir(self.points_dir):
+            if not entry.name.endswith(".json"):
+                continue
+
+            try:
+                with open(entry.path) as f:
+                    data = json.load(f)
+
+                if data.pop("format", None) != self.FORMAT_VERSION:
+                    continue
+
+                points.append(RestorePoint(**data))
+            except (OSError, ValueError, TypeError):
+                print(f"Ignoring unreadable restore point {entry.name}")
+
+        return sorted(points, key=lambda point: point.date)
+
+    def _save(self, point: RestorePoint) -> None:
+        # Write to temp file first so a crash never leaves a partial restore point behind
+        fd, tmp = tempfile.mkstemp(dir=self.points_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"format": self.FORMAT_VERSION, **asdict(point)}, f, separators=(",", ":"))
+        os.replace(tmp, self.points_dir / f"{point.id}.json")
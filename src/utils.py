@@ -2,42 +2,156 @@ import sys
 import os
 import pathlib
 import shutil
-import pefile
-
-from tkinter import Text
+import hashlib
+import mmap
 
 
 def get_exe_name() -> str:
     return "AoE2DE_s.exe"
 
 
+# (path, size, modification time) -> version number of already read binaries
+_binary_versions: dict[tuple[str, int, int], tuple[int, int, int, int]] = {}
+
+# Resource type of version information
+RT_VERSION = 16
+# Signature of VS_FIXEDFILEINFO
+VS_FIXEDFILEINFO_SIGNATURE = 0xFEEF04BD
+
+
 def get_binary_version(path: pathlib.Path) -> tuple[int, int, int, int]:
     """Retrieve the version number of a binary file.
+    The result is cached until the size or modification time of the file changes.
 
     Args:
         path (pathlib.Path): The path to the file
 
+    Raises:
+        ValueError: If the file is no valid PE binary or doesn't contain a version
+
+    Returns:
+        tuple: Windows version number
+    """
+    stat = os.stat(path)
+    key = (str(pathlib.Path(path).absolute()), stat.st_size, stat.st_mtime_ns)
+
+    version_number = _binary_versions.get(key)
+
+    if version_number is None:
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                version_number = _read_binary_version(mapped)
+
+        _binary_versions[key] = version_number
+
+    return version_number
+
+
+def _read_binary_version(data: mmap.mmap) -> tuple[int, int, int, int]:
+    """Read the version number of a PE binary. Only the headers and the path through the resource tree down to VS_FIXEDFILEINFO are read.
+
+    Args:
+        data (mmap.mmap): The mapped binary
+
+    Raises:
+        ValueError: If the binary is no valid PE binary or doesn't contain a version
+
     Returns:
         tuple: Windows version number
     """
-    # Untested under linux, but I would assume it works..
-    # TODO: Test
-    with pefile.PE(path, fast_load=True) as pe:
-        pe.parse_data_directories(directories=[pefile.DIRECTORY_ENTRY["IMAGE_DIRECTORY_ENTRY_RESOURCE"]])
+    def u16(offset: int) -> int:
+        return int.from_bytes(data[offset:offset + 2], "little")
+
+    def u32(offset: int) -> int:
+        return int.from_bytes(data[offset:offset + 4], "little")
+
+    if data[:2] != b"MZ":
+        raise ValueError("Binary has no DOS header")
+
+    pe_header = u32(0x3C)
+    if data[pe_header:pe_header + 4] != b"PE\0\0":
+        raise ValueError("Binary has no PE header")
+
+    # COFF header
+    section_count = u16(pe_header + 6)
+    optional_header_size = u16(pe_header + 20)
+    optional_header = pe_header + 24
 
-        if not hasattr(pe, "VS_FIXEDFILEINFO") or not pe.VS_FIXEDFILEINFO:
-            raise ValueError("Could not find VS_FIXEDFILEINFO in binary")
+    # Data directories start at a different offset for PE32 and PE32+
+    match u16(optional_header):
+        case 0x10B:
+            directory_count = u32(optional_header + 92)
+            directories = optional_header + 96
+        case 0x20B:
+            directory_count = u32(optional_header + 108)
+            directories = optional_header + 112
+        case magic:
+            raise ValueError(f"Unknown optional header {magic:#x}")
 
-        file_info = pe.VS_FIXEDFILEINFO[0]
+    # The resource directory is the third data directory
+    if directory_count <= 2 or u32(directories + 16) == 0:
+        raise ValueError("Binary has no resources")
 
-        version_number = (
-            file_info.FileVersionMS >> 16,
-            file_info.FileVersionMS & 0xFFFF,
-            file_info.FileVersionLS >> 16,
-            file_info.FileVersionLS & 0xFFFF
-        )
+    resource_rva = u32(directories + 16)
 
-        return version_number
+    # Map relative virtual addresses to file offsets using the section table
+    sections = []
+    for i in range(section_count):
+        section = optional_header + optional_header_size + i * 40
+        sections.append((u32(section + 12), max(u32(section + 8), u32(section + 16)), u32(section + 20)))
+
+    def to_offset(rva: int) -> int:
+        for address, size, raw_offset in sections:
+            if address <= rva < address + size:
+                return rva - address + raw_offset
+
+        raise ValueError(f"Address {rva:#x} is outside of all sections")
+
+    resources = to_offset(resource_rva)
+
+    def find_entry(directory: int, id: int | None) -> int:
+        """Find an entry of a resource directory by its id or take the first one. Returns the offset of its content."""
+        named_count = u16(directory + 12)
+        id_count = u16(directory + 14)
+
+        for i in range(named_count + id_count):
+            entry = directory + 16 + i * 8
+
+            # Named entries come first and never match an id
+            if id is None or (i >= named_count and u32(entry) == id):
+                return u32(entry + 4)
+
+        raise ValueError("Binary has no version resource")
+
+    # Type -> name -> language, directories are marked by the highest bit
+    content = find_entry(resources, RT_VERSION)
+    for _ in range(2):
+        if not content & 0x80000000:
+            raise ValueError("Unexpected layout of the resource tree")
+        content = find_entry(resources + (content & 0x7FFFFFFF), None)
+
+    if content & 0x80000000:
+        raise ValueError("Unexpected layout of the resource tree")
+
+    # Data entry of VS_VERSIONINFO, VS_FIXEDFILEINFO follows the key and its padding
+    version_info = to_offset(u32(resources + content))
+    version_info_size = u32(resources + content + 4)
+    fixed_file_info = data.find(VS_FIXEDFILEINFO_SIGNATURE.to_bytes(4, "little"), version_info, version_info + version_info_size)
+
+    if fixed_file_info < 0:
+        raise ValueError("Could not find VS_FIXEDFILEINFO in binary")
+
+    file_version_ms = u32(fixed_file_info + 8)
+    file_version_ls = u32(fixed_file_info + 12)
+
+    version_number = (
+        file_version_ms >> 16,
+        file_version_ms & 0xFFFF,
+        file_version_ls >> 16,
+        file_version_ls & 0xFFFF
+    )
+
+    return version_number
 
 
 def get_game_version(game_dir: pathlib.Path) -> int:
@@ -51,103 +165,173 @@ def get_game_version(game_dir: pathlib.Path) -> int:
     return (metadata[1] - 101) * 65536 + metadata[2]
 
 
-def log(text_widget: Text, text: str) -> None:
-    """Logs a given string to the text widget.
+def manifest_path(name: str) -> pathlib.Path:
+    """Convert a file name as listed in a manifest to a relative path for the current platform.
 
     Args:
-        text_widget (Text): The text widget
-        text (str): The text
+        name (str): The file name from the manifest
+
+    Returns:
+        pathlib.Path: The relative path
     """
-    text_widget.configure(state="normal")
-    text_widget.insert("end", text)
-    text_widget.configure(state="disabled")
-    text_widget.see("end")
+    return pathlib.Path(*name.replace("\\", "/").split("/"))
 
 
-def copy_file_or_dir(source_dir: pathlib.Path, target_dir: pathlib.Path, file: str) -> None:
-    """Copies a file or a directory recursively into the target directory.
+def sha1_file(path: pathlib.Path) -> str:
+    """Calculate the SHA-1 hash of a file like it is listed in the manifests.
 
     Args:
-        source_dir (pathlib.Path): The source directory
-        target_dir (pathlib.Path): The target directory
-        file (str): The file or directory name
+        path (pathlib.Path): The path to the file
+
+    Returns:
+        str: The hex digest of the file content
+    """
+    sha = hashlib.sha1()
+
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+
+        # Map large files into memory, hashing the mapping avoids copying every chunk into a Python buffer
+        if size >= 16 * 1024 * 1024:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                sha.update(mapped)
+        else:
+            while chunk := f.read(1024 * 1024):
+                sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def copy_file_with_hash(source: pathlib.Path, target: pathlib.Path, expected: str | None = None) -> str:
+    """Copy a file and calculate its SHA-1 hash while copying so the content is only read once.
+
+    Args:
+        source (pathlib.Path): The source file
+        target (pathlib.Path): The target file
+        expected (str, optional): The expected hash, the target is removed if the copied content doesn't match. Defaults to None.
+
+    Raises:
+        ValueError: If the hash doesn't match the expected one
+
+    Returns:
+        str: The hex digest of the copied content
+    """
+    sha = hashlib.sha1()
+
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        while chunk := src.read(1024 * 1024):
+            sha.update(chunk)
+            dst.write(chunk)
+
+    shutil.copystat(source, target)
+
+    if expected is not None and sha.hexdigest() != expected.lower():
+        target.unlink()
+        raise ValueError(f"Content of {source} doesn't match the expected hash")
+
+    return sha.hexdigest()
+
+
+def clone_file(source: pathlib.Path, target: pathlib.Path) -> None:
+    """Copies a file using a copy-on-write clone if the file system supports it and a regular copy otherwise.
+    The target never shares data with the source, modifying one will not affect the other.
+
+    Args:
+        source (pathlib.Path): The source file
+        target (pathlib.Path): The target file
     """
-    if (source_dir / file).is_dir():
-        shutil.copytree((source_dir / file).absolute(), (target_dir / file).absolute())
-    else:
-        shutil.copy((source_dir / file).absolute(), (target_dir / file).absolute())
+    if sys.platform == "linux":
+        import fcntl
+
+        FICLONE = 0x40049409
 
+        try:
+            with open(source, "rb") as src, open(target, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            shutil.copystat(source, target)
+            return
+        except OSError:
+            # File system doesn't support cloning, fall back to a regular copy
+            pass
 
-def remove_file_or_dir(path: pathlib.Path) -> None:
-    """Removes a file or directory recursively. Does not throw an error if file does not exist.
+    shutil.copy2(source, target)
+
+
+def move_file(source: pathlib.Path, target: pathlib.Path) -> None:
+    """Move a file, replacing the target if it exists. Renames the file if both paths are on the same drive and copies it otherwise.
 
     Args:
-        path (pathlib.Path): The path to be removed
+        source (pathlib.Path): The source file
+        target (pathlib.Path): The target file
     """
-    if path.is_dir():
-        shutil.rmtree(path.absolute(), ignore_errors=True)
-    else:
-        path.unlink(missing_ok=True)
+    try:
+        os.replace(source, target)
+    except OSError:
+        # Different drive, the content has to be copied
+        shutil.copy2(source, target)
+        source.unlink()
 
 
-def backup_files(original_dir: pathlib.Path, override_dir: pathlib.Path, backup_dir: pathlib.Path, debug_info: bool) -> None:
-    """Recursively performs backup of original_dir to backup_dir assuming all files/folder from override_dir will be patched.
+def move_dir_contents(source_dir: pathlib.Path, target_dir: pathlib.Path, ignore: set[str] | None = None) -> None:
+    """Recursively moves all files from source_dir into target_dir, merging with already existing directories.
 
     Args:
-        original_dir (pathlib.Path): The original directory
-        override_dir (pathlib.Path): The directory containing files / directories that will be overridden
-        backup_dir (pathlib.Path): The directory where the backup will be placed
-        debug_info (bool): Flag for printing debug info
-    """
-    changed_file_list = list(set(os.listdir(original_dir.absolute())).intersection(set(os.listdir(override_dir.absolute()))))
-
-    for file in changed_file_list:
-        # Its a folder, backup its contents
-        if (original_dir / file).is_dir():
-            (backup_dir / file).mkdir()
-            backup_files(original_dir / file, override_dir / file, backup_dir / file, debug_info)
-        # Its a file, copy it
+        source_dir (pathlib.Path): The source directory
+        target_dir (pathlib.Path): The target directory
+        ignore (set[str], optional): Names of files / directories on the top level that won't be moved. Defaults to None.
+    """
+    for entry in os.scandir(source_dir):
+        if ignore is not None and entry.name in ignore:
+            continue
+
+        target = target_dir / entry.name
+
+        if entry.is_dir():
+            target.mkdir(exist_ok=True)
+            move_dir_contents(pathlib.Path(entry.path), target)
         else:
-            if debug_info:
-                print(f"Copy {(original_dir / file).absolute()}")
+            os.replace(entry.path, target)
+
 
-            copy_file_or_dir(original_dir, backup_dir, file)
+def backup_file(source: pathlib.Path, target: pathlib.Path, move: bool = True) -> None:
+    """Backup a single file without copying its content where possible.
+    The file is renamed if it may be moved and both paths are on the same drive, otherwise it is cloned or copied.
 
+    Args:
+        source (pathlib.Path): The file
+        target (pathlib.Path): The path of the backup
+        move (bool, optional): The source file may be moved. Defaults to True.
+    """
+    if move:
+        try:
+            os.replace(source, target)
+            return
+        except OSError:
+            # Different drive, the content has to be copied
+            pass
+
+    clone_file(source, target)
 
-def remove_patched_files(original_dir: pathlib.Path, override_dir: pathlib.Path, debug_info: bool) -> None:
-    """Recursively removes all patched files assuming original_dir has been patched with all files from override_dir.
+
+def format_size(size: int) -> str:
+    """Format a number of bytes in a human readable way.
 
     Args:
-        original_dir (pathlib.Path): The original directory
-        override_dir (pathlib.Path): The directory containing the files that have been overridden
-        debug_info (bool): Flag for printing debug info
+        size (int): The number of bytes
 
-    Raises:
-            Exception: If there was an error removing files
+    Returns:
+        str: The formatted size (ex: 1.5 GB)
     """
-    changed_file_list = os.listdir(override_dir.absolute())
+    if size < 1024:
+        return f"{size} B"
 
-    # Remove all overridden files
-    try:
-        for file in changed_file_list:
-            # Its a folder, remove its contents
-            if (original_dir / file).is_dir():
-                remove_patched_files(original_dir / file, override_dir / file, debug_info)
-
-                # Remove directory if its now empty
-                if len(os.listdir((original_dir / file).absolute())) == 0:
-                    if debug_info:
-                        print(f"Remove {(original_dir / file).absolute()}")
+    for unit in ["KB", "MB", "GB"]:
+        size /= 1024
 
-                    remove_file_or_dir(original_dir / file)
-            # Its a file, remove it
-            else:
-                if debug_info:
-                    print(f"Remove {(original_dir / file).absolute()}")
+        if size < 1024 or unit == "GB":
+            break
 
-                remove_file_or_dir(original_dir / file)
-    except Exception as e:
-        raise e
+    return f"{size:.1f} {unit}"
 
 
 def check_dotnet() -> bool:
@@ -205,3 +389,21 @@ def clear() -> None:
     """Clear the screen of the console.
     """
     _ = os.system('cls')
+
+
+def format_duration(seconds: float) -> str:
+    """Format a number of seconds in a human readable way.
+
+    Args:
+        seconds (float): The number of seconds
+
+    Returns:
+        str: The formatted duration (ex: 1:05:09 or 5:09)
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+
+    if hours > 0:
+        return f"{hours}:{minutes:02}:{seconds:02}"
+
+    return f"{minutes}:{seconds:02}"
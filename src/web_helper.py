@@ -1,19 +1,54 @@
+import hashlib
 import json
-from typing import Any
+import os
+import pathlib
+import tempfile
+import threading
+from typing import TYPE_CHECKING, Any
 
-import requests
+from patch_history import PatchHistory
+
+# Imported on first use, requests takes a noticeable part of the start-up time
+if TYPE_CHECKING:
+    import requests
 
 
 class WebHelper:
+    """Queries the remote data of the patcher over a pooled session.
+
+    Responses are cached on disk and revalidated with conditional requests so unchanged data only costs a 304.
+    Every request is bounded by connect and read timeouts and retried with backoff on connection errors and server errors.
+    If the remote can't be reached the cached response is used instead.
+    The session is created on the first request so constructing the helper is cheap.
+    """
+    BASE_URL = "https://raw.githubusercontent.com/DJSchaffner/AoE2PatchReverter/master/remote"
+
+    def __init__(self, cache_dir: pathlib.Path | None = None, timeout: tuple[float, float] = (5, 15), retries: int = 3, backoff: float = 0.5,
+                 pool_size: int = 8):
+        # Cached responses are disabled if this is None
+        self.cache_dir = cache_dir
+        # Connect and read timeout in seconds
+        self.timeout = timeout
+        # Number of retries of a failed request and the backoff factor in seconds between them
+        self.retries = retries
+        self.backoff = backoff
+        # Maximum number of pooled connections, published diffs are queried concurrently
+        self.pool_size = pool_size
+        self.session: "requests.Session | None" = None
+        self.session_lock = threading.Lock()
+
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
     def query_latest_version(self) -> tuple[int, int]:
         """Returns the latest version of the patch tool.
 
         Returns:
             major, minor: The latest version of the patch tool (ex: 2, 0)
         """
-        url = "https://raw.githubusercontent.com/DJSchaffner/AoE2PatchReverter/master/remote/version.txt"
-        response = self._query_website(url)
-        major, minor = list(map(int, response.text.split(".")))
+        url = f"{self.BASE_URL}/version.txt"
+        content = self._query_cached(url)
+        major, minor = list(map(int, content.decode().split(".")))
 
         return major, minor
 
@@ -23,13 +58,118 @@ class WebHelper:
         Returns:
             list: A list of all documented patches
         """
-        url = "https://raw.githubusercontent.com/DJSchaffner/AoE2PatchReverter/master/remote/patches.json"
+        url = f"{self.BASE_URL}/patches.json"
 
-        response = self._query_website(url)
-        result = json.loads(response.content)["patches"]
+        content = self._query_cached(url)
+        result = json.loads(content)["patches"]
 
         return result
 
+    def query_patch_history(self) -> PatchHistory:
+        """Query the compact history of all patches. Falls back to the list of all patches if the history hasn't been published.
+
+        Returns:
+            PatchHistory: The history of all documented patches
+        """
+        content = self._query_cached(f"{self.BASE_URL}/history.jsonl", ignore_success=True)
+
+        if content is None:
+            return PatchHistory.from_patches(self.query_patches())
+
+        return PatchHistory.parse(content)
+
+    def cached_patch_history(self) -> PatchHistory | None:
+        """Get the history of all patches from the last successful query without querying the website.
+
+        Returns:
+            PatchHistory | None: The history of all documented patches or None if it has never been queried
+        """
+        cached = self._read_cache(f"{self.BASE_URL}/history.jsonl")
+        if cached is not None:
+            return PatchHistory.parse(cached[1])
+
+        cached = self._read_cache(f"{self.BASE_URL}/patches.json")
+        if cached is not None:
+            return PatchHistory.from_patches(json.loads(cached[1])["patches"])
+
+        return None
+
+    def query_diff(self, old_version: int, new_version: int) -> dict | None:
+        """Query the precomputed changes between two consecutive versions.
+
+        Args:
+            old_version (int): The older version
+            new_version (int): The next newer version
+
+        Returns:
+            dict | None: The changes of every changed depot or None if they haven't been published
+        """
+        url = f"{self.BASE_URL}/diffs/{old_version}-{new_version}.json"
+
+        # Published changes between two versions never change, a cached copy doesn't have to be revalidated
+        content = self._query_cached(url, ignore_success=True, revalidate=False)
+
+        if content is None:
+            return None
+
+        return json.loads(content)
+
+    def _query_cached(self, url: str, ignore_success: bool = False, revalidate: bool = True) -> bytes | None:
+        """Query a website and cache its content. Cached content is revalidated with a conditional request.
+
+        Args:
+            url (str): The url of the website to be queried
+            ignore_success (bool, optional): If set to true, return None instead of raising an exception if the response is not successful. Defaults to False.
+            revalidate (bool, optional): If set to false, cached content is used without querying the website. Defaults to True.
+
+        Raises:
+            requests.RequestException: If the website can't be reached and nothing is cached
+
+        Returns:
+            bytes | None: The content of the website
+        """
+        import requests
+
+        cached = self._read_cache(url)
+
+        if cached is not None and not revalidate:
+            return cached[1]
+
+        headers = {}
+        if cached is not None:
+            if cached[0].get("etag"):
+                headers["If-None-Match"] = cached[0]["etag"]
+            if cached[0].get("last_modified"):
+                headers["If-Modified-Since"] = cached[0]["last_modified"]
+
+        try:
+            response = self._query_website(url, headers, ignore_success=True)
+        except requests.RequestException as e:
+            if cached is None:
+                raise
+
+            print(f"Using cached data, could not reach {url}: {e}")
+            return cached[1]
+
+        if response.status_code == 304 and cached is not None:
+            return cached[1]
+
+        if not self._is_response_successful(response):
+            if ignore_success:
+                return None
+
+            if cached is not None:
+                self._print_response_error(response)
+                print("Using cached data instead")
+                return cached[1]
+
+            self._print_response_error(response)
+            raise requests.RequestException("Received error on request when expecting valid response")
+
+        self._write_cache(url, response)
+
+        return response.content
+
     def _query_website(self, url: str, headers: dict | None = None, ignore_success: bool = False) -> Any:
         """Query a website with the given headers.
 
@@ -41,9 +181,10 @@ class WebHelper:
         Returns:
             requests.Response: The response of the request
         """
+        import requests
 
         # Doesn't work with cloudflare blocking access
-        response = requests.get(url, headers=headers)
+        response = self._get_session().get(url, headers=headers, timeout=self.timeout)
 
         if (not ignore_success) and (not self._is_response_successful(response)):
             self._print_response_error(response)
@@ -51,7 +192,90 @@ class WebHelper:
 
         return response
 
-    def _is_response_successful(self, response: requests.Response) -> bool:
+    def _get_session(self) -> "requests.Session":
+        """Get the shared session, it is created on first use.
+
+        Returns:
+            requests.Session: The session
+        """
+        with self.session_lock:
+            if self.session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+
+                retry = Retry(total=self.retries, backoff_factor=self.backoff, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"],
+                              raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry)
+
+                # Connections are reused by all requests
+                self.session = requests.Session()
+                self.session.mount("https://", adapter)
+                self.session.mount("http://", adapter)
+
+            return self.session
+
+    def _cache_path(self, url: str) -> pathlib.Path:
+        return self.cache_dir / hashlib.sha1(url.encode()).hexdigest()
+
+    def _read_cache(self, url: str) -> tuple[dict, bytes] | None:
+        """Read the cached response of a url.
+
+        Args:
+            url (str): The url
+
+        Returns:
+            tuple[dict, bytes] | None: The validators and the content or None if nothing is cached
+        """
+        if self.cache_dir is None:
+            return None
+
+        path = self._cache_path(url)
+
+        try:
+            with open(path.with_suffix(".json")) as f:
+                validators = json.load(f)
+
+            with open(path.with_suffix(".body"), "rb") as f:
+                content = f.read()
+        except (OSError, ValueError):
+            return None
+
+        # Content has been replaced or damaged in the meantime
+        if validators.get("url") != url or validators.get("sha1") != hashlib.sha1(content).hexdigest():
+            return None
+
+        return validators, content
+
+    def _write_cache(self, url: str, response: "requests.Response") -> None:
+        """Cache the content of a successful response along with its validators.
+
+        Args:
+            url (str): The url
+            response (requests.Response): The response
+        """
+        if self.cache_dir is None:
+            return
+
+        path = self._cache_path(url)
+        validators = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "sha1": hashlib.sha1(response.content).hexdigest()
+        }
+
+        try:
+            # Write to temp files first so a crash never leaves a partial entry behind, the checksum detects mismatched pairs
+            for suffix, data in [(".body", response.content), (".json", json.dumps(validators).encode())]:
+                fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path.with_suffix(suffix))
+        except OSError as e:
+            print(f"Could not cache {url}: {e}")
+
+    def _is_response_successful(self, response: "requests.Response") -> bool:
         """Checks if a response returned successfully.
 
         Args:
@@ -62,7 +286,7 @@ class WebHelper:
         """
         return response.status_code == 200
 
-    def _print_response_error(self, response: requests.Response) -> None:
+    def _print_response_error(self, response: "requests.Response") -> None:
         """Print the according error for a response.
 
         Args: